@@ -1,5 +1,13 @@
 import copy
 import os
+import pathlib
+import sqlite3
+import sys
+
+try:
+    import numpy as np
+except ImportError:
+    raise ImportError("numpy is not installed, run `pip install numpy`.")
 
 from promethium_sdk.client import PromethiumClient
 from promethium_sdk.models import (
@@ -9,6 +17,11 @@ from promethium_sdk.utils import (
     base64encode,
 )
 
+sys.path.append(str(pathlib.Path(__file__).resolve().parents[2]))
+from conformer_ensemble import load_conformers
+from workflow_polling import wait_for_workflows
+from workflow_submissions import submission_hash
+
 # Note:
 # Run times for some of these conformers searches is non-trivial ~1-1.5hrs wall time
 # with slightly more than that in total GPU time.
@@ -16,6 +29,11 @@ from promethium_sdk.utils import (
 foldername = "output"
 gpu_type = os.getenv("PM_GPU_TYPE", "a100")
 
+# Every submission is recorded in this ledger, so that this script can be stopped and
+# re-run at any point: payloads already submitted are not submitted again, and only the
+# workflows whose results have not been collected yet are polled.
+ledger_path = os.path.join(foldername, "ledger.sqlite")
+
 # Should we add a coarse DFT filter?
 coarse_dft = True
 
@@ -93,6 +111,72 @@ coarse_dft_filter = {
 
 prom = PromethiumClient()
 
+
+class SubmissionLedger:
+    """
+    SQLite ledger of submitted workflows: the payload hash, workflow id, name, last
+    known status and the paths of the saved artifacts of each submission.
+
+    Every change is committed immediately, so the ledger survives a crash at any point,
+    and the status index keeps the outstanding workflows a cheap query however large
+    the campaign.
+    """
+
+    def __init__(self, path):
+        self.connection = sqlite3.connect(path)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        with self.connection:
+            self.connection.execute(
+                """
+                CREATE TABLE IF NOT EXISTS submissions (
+                    payload_hash TEXT PRIMARY KEY,
+                    workflow_id TEXT NOT NULL UNIQUE,
+                    name TEXT NOT NULL,
+                    status TEXT NOT NULL,
+                    results_path TEXT,
+                    conformers_path TEXT,
+                    submitted_at TEXT NOT NULL DEFAULT CURRENT_TIMESTAMP,
+                    updated_at TEXT NOT NULL DEFAULT CURRENT_TIMESTAMP
+                )
+                """
+            )
+            self.connection.execute("CREATE INDEX IF NOT EXISTS submissions_status ON submissions (status)")
+
+    def status(self, payload_hash):
+        """Return the last known status of the submission with this payload hash, or None."""
+        row = self.connection.execute(
+            "SELECT status FROM submissions WHERE payload_hash = ?", (payload_hash,)
+        ).fetchone()
+        return row[0] if row else None
+
+    def record_submission(self, payload_hash, workflow_id, name):
+        with self.connection:
+            self.connection.execute(
+                "INSERT OR REPLACE INTO submissions (payload_hash, workflow_id, name, status) VALUES (?, ?, ?, ?)",
+                (payload_hash, str(workflow_id), name, "SUBMITTED"),
+            )
+
+    def record_status(self, workflow_id, status, results_path=None, conformers_path=None):
+        with self.connection:
+            self.connection.execute(
+                """
+                UPDATE submissions
+                SET status = ?, results_path = ?, conformers_path = ?, updated_at = CURRENT_TIMESTAMP
+                WHERE workflow_id = ?
+                """,
+                (status, results_path, conformers_path, str(workflow_id)),
+            )
+
+    def outstanding(self):
+        """Return the ids of the workflows whose results have not been collected yet."""
+        rows = self.connection.execute("SELECT workflow_id FROM submissions WHERE status = ?", ("SUBMITTED",))
+        return [row[0] for row in rows]
+
+    def counts(self):
+        """Return the number of submissions by status."""
+        return dict(self.connection.execute("SELECT status, COUNT(*) FROM submissions GROUP BY status"))
+
+
 SMILES = [
     "C1=CN=C(C=N1)C(=O)N",
     "CC(=O)OC1=CC=CC=C1C(=O)O",
@@ -103,44 +187,64 @@ SMILES = [
     "CCCC(C)C1(C(=O)NC(=O)NC1=O)CC=C",
 ]
 
-workflow_ids = []
-for i, smile in enumerate(SMILES):
-    tmp_job_params = copy.deepcopy(job_params)
-    # Set the molecule:
-    tmp_job_params["name"] = f"conformer-search-GS-{i}{'-DFT' if coarse_dft else ''}"
-    tmp_job_params["parameters"]["molecule"] = {
-        "base64data": base64encode(smile),
-        "filetype": "smi",
-    }
-    # Optionally add the coarse DFT filter:
-    if coarse_dft:
-        tmp_job_params["parameters"]["filters"].append(coarse_dft_filter)
-    payload = CreateConformerSearchWorkflowRequest(**tmp_job_params)
-    # Submit but don't wait:
-    workflow = prom.workflows.submit(payload)
-    workflow_ids.append(workflow.id)
-    print(f"Workflow {workflow.name} submitted with id: {workflow.id}")
-
-# Wait for all workflows to complete:
-# Actually no need to do this here.
-# It often makes sense to decouple the submission script from the results
-# generation script. That way, the submission script can run,
-# generate the workflow ids (store them), and then the results generation script
-# can be run at a later time (and re-run if there are bugs).
-# This is especially useful if you are running many workflows.
-# However, for simplicity here, we wait in the same script.
-for workflow_id in workflow_ids:
-    prom.workflows.wait(workflow_id)
-
-    workflow = prom.workflows.get(workflow_id)
+ledger = SubmissionLedger(ledger_path)
+
+# Submit the conformer searches, unless only collecting with `python run.py collect`.
+if sys.argv[1:] != ["collect"]:
+    for i, smile in enumerate(SMILES):
+        tmp_job_params = copy.deepcopy(job_params)
+        # Set the molecule:
+        tmp_job_params["name"] = f"conformer-search-GS-{i}{'-DFT' if coarse_dft else ''}"
+        tmp_job_params["parameters"]["molecule"] = {
+            "base64data": base64encode(smile),
+            "filetype": "smi",
+        }
+        # Optionally add the coarse DFT filter:
+        if coarse_dft:
+            tmp_job_params["parameters"]["filters"].append(coarse_dft_filter)
+        payload = CreateConformerSearchWorkflowRequest(**tmp_job_params)
+
+        # Skip payloads that were already submitted and did not fail:
+        payload_hash = submission_hash(payload)
+        if ledger.status(payload_hash) not in (None, "FAILED", "CANCELLED"):
+            print(f"Workflow {payload.name} already submitted, skipping.")
+            continue
+
+        # Submit but don't wait:
+        workflow = prom.workflows.submit(payload)
+        ledger.record_submission(payload_hash, workflow.id, workflow.name)
+        print(f"Workflow {workflow.name} submitted with id: {workflow.id}")
+
+# Collect the results of every workflow in the ledger that has not been collected yet.
+# Submission and collection are decoupled through the ledger: the collection can be
+# interrupted and restarted with `python run.py collect` (even from another machine
+# with a copy of the ledger), and only fetches what is still outstanding.
+print(f"Submissions by status: {ledger.counts()}")
+for workflow in wait_for_workflows(prom, ledger.outstanding()):
+    workflow_id = workflow.id
     print(f"Workflow {workflow.name} completed with status: {workflow.status}")
     print(f"Workflow completed in {workflow.duration_seconds:.2f}s")
+    if workflow.status.value != "COMPLETED":
+        ledger.record_status(workflow_id, workflow.status.value)
+        continue
 
     cs_results = prom.workflows.results(workflow_id)
-    with open(os.path.join(foldername, f"{workflow.name}_results.json"), "w") as fp:
+    results_path = os.path.join(foldername, f"{workflow.name}_results.json")
+    with open(results_path, "w") as fp:
         fp.write(cs_results.model_dump_json(indent=2))
 
-    # Get conformers:
-    conformers = cs_results.get_artifact("conformers")
+    # Load the conformer ensemble into arrays, and save them for further analysis.
+    conformers = load_conformers(cs_results.get_artifact("conformers"), cs_results.results)
+    conformers_path = os.path.join(foldername, f"{workflow.name}_conformers.npz")
+    np.savez(conformers_path, **conformers)
     print("Conformers:\n====================\n")
-    print(conformers)
+    print(f"{'Rank':>6s} {'Index':>6s} {'Rel Energy':>12s} {'Weight':>10s}")
+    for rank, (index, energy, weight) in enumerate(
+        zip(conformers["indices"], conformers["energies"], conformers["weights"])
+    ):
+        print(f"{rank + 1:6d} {index:6d} {energy:12.6f} {weight:10.6f}")
+    print()
+
+    ledger.record_status(workflow_id, workflow.status.value, results_path, conformers_path)
+
+print(f"Submissions by status: {ledger.counts()}")
@@ -0,0 +1,46 @@
+"""
+Multi-XYZ conformer ensembles as NumPy arrays, shared by the examples that post-process
+conformer search results.
+"""
+try:
+    import numpy as np
+except ImportError:
+    raise ImportError("numpy is not installed, run `pip install numpy`.")
+
+
+def load_conformers(xyz_text, cs_results=None):
+    """
+    Parse a multi-XYZ conformer ensemble, where every block has the same atoms, into a
+    shared (n_atoms,) element array and an (n_conf, n_atoms, 3) coordinate array.
+
+    If the conformer search results are given, the per-conformer `indices`, relative
+    `energies` and Boltzmann `weights` are attached as arrays in the same order.
+    """
+    lines = xyz_text.strip().splitlines()
+    n_atoms = int(lines[0])
+    block_size = n_atoms + 2
+    n_conf = (len(lines) + 1) // block_size
+    blocks = [lines[i * block_size + 2:(i + 1) * block_size] for i in range(n_conf)]
+    fields = np.array(" ".join(line for block in blocks for line in block).split()).reshape(n_conf, n_atoms, 4)
+    elements = fields[0, :, 0]
+    if not (fields[:, :, 0] == elements).all():
+        raise ValueError("Conformers do not all have the same atoms in the same order.")
+
+    conformers = {
+        "elements": elements,
+        "coordinates": fields[:, :, 1:].astype(np.float64),
+    }
+    if cs_results is not None:
+        conformers["indices"] = np.asarray(cs_results["indices"])
+        conformers["energies"] = np.asarray(cs_results["energies"], dtype=np.float64)
+        conformers["weights"] = np.asarray(cs_results["weights"], dtype=np.float64)
+    return conformers
+
+
+def conformer_xyz(conformers, rank, comment=""):
+    """Format one conformer of the ensemble as an XYZ string, e.g. to submit it again."""
+    atom_lines = [
+        f"{element:2s} {x:16.10f} {y:16.10f} {z:16.10f}"
+        for element, (x, y, z) in zip(conformers["elements"], conformers["coordinates"][rank].tolist())
+    ]
+    return "\n".join([str(len(atom_lines)), comment] + atom_lines) + "\n"
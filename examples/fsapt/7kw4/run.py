@@ -1,11 +1,15 @@
 import json
 import httpx
 import os
+import pathlib
+import sys
 
-try:
-    import numpy as np
-except ImportError:
-    raise ImportError("numpy is not installed, run `pip install numpy`.")
+# The shared F-SAPT analysis helpers live in examples/fsapt/, and the results download in examples/.
+sys.path.append(str(pathlib.Path(__file__).resolve().parents[1]))
+sys.path.append(str(pathlib.Path(__file__).resolve().parents[2]))
+from fsapt_analysis import fsapt_table, format_fsapt_table, load_fsapt_tensors, write_fsapt_table
+from fsapt_fragments import NUCLEIC_ACID_CUTS, fragment_molecule
+from results_download import download_results
 
 from promethium_sdk.utils import (
     base64encode,
@@ -76,8 +80,7 @@ labelsA = []
 for idx in range(len(fragsA)):
     labelsA.append('A%d' % (idx+1))
 
-monomerB = base64encode(
-"""780
+monomerB_xyz = """780
 
  O         20.75000000         34.93000000         23.60400000
  C         20.02200000         33.72700000         23.79800000
@@ -860,18 +863,10 @@ monomerB = base64encode(
  H          9.76480233         21.37232992         26.21945081
  H         14.63041033         15.96656378         29.71341988
 """
-)
+monomerB = base64encode(monomerB_xyz)
 chargeB = 0
-fragsB = [[0,22,],[1,2,3,4,6,7,16,17,18,19,20,21,23,],[5,28,29,30,31,379,],[8,9,10,11,12,13,14,15,24,25,26,27,],
-    [32,33,34,35,37,38,50,51,52,53,54,55,56,],[36,61,62,63,64,380,],[39,40,41,42,43,44,45,46,47,48,49,57,58,59,60,],
-    [65,66,67,68,70,71,80,81,82,83,84,85,86,],[69,91,92,93,94,381,],[72,73,74,75,76,77,78,79,87,88,89,90,],
-    [95,96,97,98,100,101,113,114,115,116,117,118,119,],[99,124,125,126,127,382,],
-    [102,103,104,105,106,107,108,109,110,111,112,120,121,122,123,],[128,129,130,131,133,134,145,146,147,148,149,150,151,],
-    [132,156,157,158,159,383,],[135,136,137,138,139,140,141,142,143,144,152,153,154,155,],[160,161,162,163,165,166,177,178,179,180,181,182,183,],[164,188,189,190,191,384,],[167,168,169,170,171,172,173,174,175,176,184,185,186,187,],[192,193,194,195,197,198,208,209,210,211,212,213,214,],[196,220,221,222,223,385,],[199,200,201,202,203,204,205,206,207,215,216,217,218,219,],[224,225,226,227,229,230,240,241,242,243,244,245,246,],[228,252,253,254,255,386,],[231,232,233,234,235,236,237,238,239,247,248,249,250,251,],[256,257,258,259,261,262,271,272,273,274,275,276,277,],[260,282,283,284,285,387,],[263,264,265,266,267,268,269,270,278,279,280,281,],[286,287,288,289,291,292,304,305,306,307,308,309,310,],[290,315,316,317,318,388,],[293,294,295,296,297,298,299,300,301,302,303,311,312,313,314,],[319,320,321,322,324,325,334,335,336,337,338,339,340,],[323,345,346,347,348,389,],[326,327,328,329,330,331,332,333,341,342,343,344,],[349,350,351,352,354,355,367,368,369,370,371,372,374,],[353,373,],[356,357,358,359,360,361,362,363,364,365,366,375,376,377,378,],[390,412,],[391,392,393,394,396,397,406,407,408,409,410,411,413,],[395,418,419,420,421,769,],[398,399,400,401,402,403,404,405,414,415,416,417,],[422,423,424,425,427,428,440,441,442,443,444,445,446,],[426,451,452,453,454,770,],[429,430,431,432,433,434,435,436,437,438,439,447,448,449,450,],[455,456,457,458,460,461,470,471,472,473,474,475,476,],[459,481,482,483,484,771,],[462,463,464,465,466,467,468,469,477,478,479,480,],[485,486,487,488,490,491,503,504,505,506,507,508,509,],[489,514,515,516,517,772,],[492,493,494,495,496,497,498,499,500,501,502,510,511,512,513,],[518,519,520,521,523,524,535,536,537,538,539,540,541,],[522,546,547,548,549,773,],[525,526,527,528,529,530,531,532,533,534,542,543,544,545,],[550,551,552,553,555,556,567,568,569,570,571,572,573,],[554,578,579,580,581,774,],[557,558,559,560,561,562,563,564,565,566,574,575,576,577,],[582,583,584,585,587,588,598,599,600,601,602,603,604,],[586,610,611,612,613,775,],[589,590,591,592,593,594,595,596,597,605,606,607,608,609,],[614,615,616,617,619,620,630,631,632,633,634,635,636,],[618,642,643,644,645,776,],[621,622,623,624,625,626,627,628,629,637,638,639,640,641,],[646,647,648,649,651,652,661,662,663,664,665,666,667,],[650,672,673,674,675,777,],[653,654,655,656,657,658,659,660,668,669,670,671,],[676,677,678,679,681,682,694,695,696,697,698,699,700,],[680,705,706,707,708,778,],[683,684,685,686,687,688,689,690,691,692,693,701,702,703,704,],[709,710,711,712,714,715,724,725,726,727,728,729,730,],[713,735,736,737,738,779,],[716,717,718,719,720,721,722,723,731,732,733,734,],[739,740,741,742,744,745,757,758,759,760,761,762,764,],[743,763,],[746,747,748,749,750,751,752,753,754,755,756,765,766,767,768,],]
-
-labelsB = []
-for idx in range(len(fragsB)):
-    labelsB.append('B%d' % (idx+1))
+# Cut the DNA into phosphate, sugar and nucleobase fragments.
+fragsB, labelsB = fragment_molecule(monomerB_xyz, NUCLEIC_ACID_CUTS, prefix="B")
 
 job_params = {
     "name": "fsapt-test",
@@ -929,6 +924,7 @@ headers = {
 
 client = httpx.Client(base_url=base_url, headers=headers)
 
+
 payload = job_params
 jobname = payload["name"]
 print(f"Submitting {jobname}...", end="")
@@ -958,36 +954,13 @@ response = client.get(f"/v0/workflows/{workflow_id}/results").json()
 with open(os.path.join(foldername, f"{jobname}_results.json"), "w") as fp:
     fp.write(json.dumps(response))
 
-response = client.get(
-    f"/v0/workflows/{workflow_id}/results/download", follow_redirects=True
-)
-with open(os.path.join(foldername, f"{jobname}_results.zip"), "wb") as fp:
-    fp.write(response.content)
+download_results(client, workflow_id, os.path.join(foldername, f"{jobname}_results.zip"))
 
-response = client.get(f"/v0/workflows/{workflow_id}/results").json()
-
-labels_a = response['results']['fsapt']['fragment_labels']['molecule_a']
-labels_b = response['results']['fsapt']['fragment_labels']['molecule_b']
-
-Eelst = 627.5095 * np.array(response['results']['fsapt']['tensors']['Eelst'])
-Eexch = 627.5095 * np.array(response['results']['fsapt']['tensors']['Eexch'])
-EindAB = 627.5095 * np.array(response['results']['fsapt']['tensors']['EindAB'])
-EindBA = 627.5095 * np.array(response['results']['fsapt']['tensors']['EindBA'])
-Edisp = 627.5095 * np.array(response['results']['fsapt']['tensors']['Edisp'])
-Esapt = 627.5095 * np.array(response['results']['fsapt']['tensors']['Esapt'])
+frag1, frag2, values = fsapt_table(*load_fsapt_tensors(response['results']['fsapt']))
 
 print('')
 print('F-SAPT Analysis (kcal / mol)')
 print('')
-print('Frag1     Frag2         Elst     Exch    IndAB    IndBA     Disp    Total')
-for i in range(len(labels_a)):
-    for j in range(len(labels_b)):
-        print('%-9s %-9s %8.3lf %8.3lf %8.3lf %8.3lf %8.3lf %8.3lf' % (labels_a[i], labels_b[j], Eelst[i,j], Eexch[i,j], EindAB[i,j], EindBA[i,j], Edisp[i,j], Esapt[i,j]))
-
-for i in range(len(labels_a)):
-    print('%-9s %-9s %8.3lf %8.3lf %8.3lf %8.3lf %8.3lf %8.3lf' % (labels_a[i], 'All', np.sum(Eelst, axis=1)[i], np.sum(Eexch, axis=1)[i], np.sum(EindAB, axis=1)[i], np.sum(EindBA, axis=1)[i], np.sum(Edisp, axis=1)[i], np.sum(Esapt, axis=1)[i]))
-
-for i in range(len(labels_b)):
-    print('%-9s %-9s %8.3lf %8.3lf %8.3lf %8.3lf %8.3lf %8.3lf' % ('All', labels_b[i], np.sum(Eelst, axis=0)[i], np.sum(Eexch, axis=0)[i], np.sum(EindAB, axis=0)[i], np.sum(EindBA, axis=0)[i], np.sum(Edisp, axis=0)[i], np.sum(Esapt, axis=0)[i]))
+print(format_fsapt_table(frag1, frag2, values))
 
-print('%-9s %-9s %8.3lf %8.3lf %8.3lf %8.3lf %8.3lf %8.3lf' % ('All', 'All', np.sum(Eelst), np.sum(Eexch), np.sum(EindAB), np.sum(EindBA), np.sum(Edisp), np.sum(Esapt)))
+write_fsapt_table(os.path.join(foldername, f"{jobname}_fsapt.csv"), frag1, frag2, values)
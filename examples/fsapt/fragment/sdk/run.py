@@ -1,5 +1,6 @@
 import os
 import pathlib
+import sys
 
 from promethium_sdk.utils import (
     base64decode,
@@ -10,6 +11,13 @@ from promethium_sdk.models import (
     PrepareCutoutRequest,
 )
 
+# The local cutout lives in examples/local_cutout.py.
+sys.path.append(str(pathlib.Path(__file__).resolve().parents[3]))
+from local_cutout import local_cutout
+
+# Set PM_LOCAL_CUTOUT=1 to prepare the cutout locally instead of with prom.preparation.cutout.
+use_local_cutout = os.getenv("PM_LOCAL_CUTOUT", "0") == "1"
+
 foldername = "output"
 if not os.path.exists(foldername):
     os.makedirs(foldername)
@@ -28,7 +36,7 @@ prepare_cutout_request = PrepareCutoutRequest(
     ligand_name="EFD",
     include_fragments=True,
 )
-response = prom.preparation.cutout(prepare_cutout_request)
+response = local_cutout(prepare_cutout_request) if use_local_cutout else prom.preparation.cutout(prepare_cutout_request)
 
 with open(os.path.join(foldername, "results.json"), "w") as fp:
     fp.write(response.model_dump_json(indent=2))
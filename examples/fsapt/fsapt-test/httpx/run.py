@@ -1,11 +1,12 @@
 import json
 import httpx
 import os
+import pathlib
+import sys
 
-try:
-    import numpy as np
-except ImportError:
-    raise ImportError("numpy is not installed, run `pip install numpy`.")
+# The shared F-SAPT analysis helpers live in examples/fsapt/fsapt_analysis.py.
+sys.path.append(str(pathlib.Path(__file__).resolve().parents[2]))
+from fsapt_analysis import fsapt_table, format_fsapt_table, load_fsapt_tensors, write_fsapt_table
 
 from promethium_sdk.utils import (
     base64encode,
@@ -153,28 +154,11 @@ with open(os.path.join(foldername, f"{jobname}_results.zip"), "wb") as fp:
 
 response = client.get(f"/v0/workflows/{workflow_id}/results").json()
 
-labels_a = response['results']['fsapt']['fragment_labels']['molecule_a']
-labels_b = response['results']['fsapt']['fragment_labels']['molecule_b']
-
-Eelst = 627.5095 * np.array(response['results']['fsapt']['tensors']['Eelst'])
-Eexch = 627.5095 * np.array(response['results']['fsapt']['tensors']['Eexch'])
-EindAB = 627.5095 * np.array(response['results']['fsapt']['tensors']['EindAB'])
-EindBA = 627.5095 * np.array(response['results']['fsapt']['tensors']['EindBA'])
-Edisp = 627.5095 * np.array(response['results']['fsapt']['tensors']['Edisp'])
-Esapt = 627.5095 * np.array(response['results']['fsapt']['tensors']['Esapt'])
+frag1, frag2, values = fsapt_table(*load_fsapt_tensors(response['results']['fsapt']))
 
 print('')
 print('F-SAPT Analysis (kcal / mol)')
 print('')
-print('Frag1     Frag2         Elst     Exch    IndAB    IndBA     Disp    Total')
-for i in range(len(labels_a)):
-    for j in range(len(labels_b)):
-        print('%-9s %-9s %8.3lf %8.3lf %8.3lf %8.3lf %8.3lf %8.3lf' % (labels_a[i], labels_b[j], Eelst[i,j], Eexch[i,j], EindAB[i,j], EindBA[i,j], Edisp[i,j], Esapt[i,j]))
-
-for i in range(len(labels_a)):
-    print('%-9s %-9s %8.3lf %8.3lf %8.3lf %8.3lf %8.3lf %8.3lf' % (labels_a[i], 'All', np.sum(Eelst, axis=1)[i], np.sum(Eexch, axis=1)[i], np.sum(EindAB, axis=1)[i], np.sum(EindBA, axis=1)[i], np.sum(Edisp, axis=1)[i], np.sum(Esapt, axis=1)[i]))
-
-for i in range(len(labels_b)):
-    print('%-9s %-9s %8.3lf %8.3lf %8.3lf %8.3lf %8.3lf %8.3lf' % ('All', labels_b[i], np.sum(Eelst, axis=0)[i], np.sum(Eexch, axis=0)[i], np.sum(EindAB, axis=0)[i], np.sum(EindBA, axis=0)[i], np.sum(Edisp, axis=0)[i], np.sum(Esapt, axis=0)[i]))
+print(format_fsapt_table(frag1, frag2, values))
 
-print('%-9s %-9s %8.3lf %8.3lf %8.3lf %8.3lf %8.3lf %8.3lf' % ('All', 'All', np.sum(Eelst), np.sum(Eexch), np.sum(EindAB), np.sum(EindBA), np.sum(Edisp), np.sum(Esapt)))
+write_fsapt_table(os.path.join(foldername, f"{jobname}_fsapt.csv"), frag1, frag2, values)
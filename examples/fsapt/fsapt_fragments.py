@@ -0,0 +1,247 @@
+"""
+Automatic F-SAPT fragment partitioning of large molecules, used by the F-SAPT example scripts.
+
+Bonds are perceived from the XYZ coordinates with a cell-list neighbor search, so only
+atoms in adjacent cells are compared and the cost grows linearly with the number of
+atoms. The molecule is then cut at the bond types selected from `CUT_RULES`, and every
+connected piece that remains becomes one fragment, ready to use as the `fragments` and
+`fragment_names` parameters of `molecule_a` or `molecule_b`.
+"""
+try:
+    import numpy as np
+except ImportError:
+    raise ImportError("numpy is not installed, run `pip install numpy`.")
+
+# Covalent radii in Angstrom (Cordero et al., 2008). Two atoms are bonded when their
+# distance is below the sum of their radii plus BOND_TOLERANCE.
+COVALENT_RADII = {
+    "H": 0.31, "B": 0.84, "C": 0.76, "N": 0.71, "O": 0.66, "F": 0.57, "Na": 1.66, "Mg": 1.41,
+    "Si": 1.11, "P": 1.07, "S": 1.05, "Cl": 1.02, "K": 2.03, "Ca": 1.76, "Zn": 1.22, "Se": 1.20,
+    "Br": 1.20, "I": 1.39,
+}
+BOND_TOLERANCE = 0.45
+
+# Bond types that can be cut. Each rule is a pair of atom patterns, one for each end of
+# the bond: the element of the atom, and elements it must also be bonded to.
+CUT_RULES = {
+    # Ester bonds between the phosphate oxygens and the sugar carbons of nucleic acids.
+    "phosphate_sugar": (("O", {"P"}), ("C", set())),
+    # Bonds between the sugar carbons and the hydroxyl oxygens, which take the place of
+    # the phosphate at the 5' and 3' ends of a DNA strand (this also cuts RNA 2'-OH groups).
+    "sugar_hydroxyl": (("O", {"H"}), ("C", set())),
+    # Glycosidic bonds between the sugar C1' and the nucleobase nitrogen.
+    "glycosidic": (("C", {"O", "N"}), ("N", {"C"})),
+    # Bonds between the alpha carbon and the carbonyl carbon of peptides.
+    "peptide_calpha": (("C", {"N"}), ("C", {"O", "N"})),
+}
+NUCLEIC_ACID_CUTS = ["phosphate_sugar", "sugar_hydroxyl", "glycosidic"]
+PROTEIN_CUTS = ["peptide_calpha"]
+
+# Bonds in rings of up to this many atoms are never cut.
+MAX_RING_SIZE = 8
+
+
+def read_xyz(xyz):
+    """Read the capitalized elements and the (n_atoms, 3) coordinates from the contents of an XYZ file."""
+    lines = xyz.strip().splitlines()
+    n_atoms = int(lines[0])
+    tokens = " ".join(lines[2:2 + n_atoms]).split()
+    if len(tokens) != 4 * n_atoms:
+        raise ValueError(f"Expected {n_atoms} atoms with an element and 3 coordinates each.")
+    # Converting the coordinates straight from the Python strings is several times
+    # faster than through a NumPy string array.
+    element_tokens = tokens[0::4]
+    del tokens[0::4]
+    unique_elements, element_index = np.unique(element_tokens, return_inverse=True)
+    elements = np.array([element.capitalize() for element in unique_elements])[element_index]
+    return elements, np.array(tokens, dtype=np.float64).reshape(n_atoms, 3)
+
+
+def perceive_bonds(elements, coordinates):
+    """
+    Return the bonded atom pairs as an (n_bonds, 2) array with i < j, from a cell-list
+    search over cells as large as the longest possible bond.
+    """
+    unique_elements, element_index = np.unique(elements, return_inverse=True)
+    radii = np.array([COVALENT_RADII.get(element, 1.5) for element in unique_elements])[element_index]
+    cell_size = 2 * radii.max() + BOND_TOLERANCE
+    cells = np.floor((coordinates - coordinates.min(axis=0)) / cell_size).astype(np.int64) + 1
+    dims = cells.max(axis=0) + 2
+    keys = (cells[:, 0] * dims[1] + cells[:, 1]) * dims[2] + cells[:, 2]
+    order = np.argsort(keys, kind="stable")
+    sorted_keys = keys[order]
+
+    # The occupied cells, and the range of their atoms in `order`. The coordinates and
+    # radii are sorted by cell too, so the atoms of a cell are read contiguously.
+    cell_keys, cell_start, cell_counts = np.unique(sorted_keys, return_index=True, return_counts=True)
+    sorted_coordinates = coordinates[order]
+    sorted_radii = radii[order] + BOND_TOLERANCE / 2
+
+    # Every pair of neighboring cells is visited once: the cell itself, and the 13 of its
+    # 26 neighbors whose key offset is positive. The pairs are filtered by distance per
+    # direction, so only bonded pairs are kept in memory.
+    directions = [(dx, dy, dz) for dx in (-1, 0, 1) for dy in (-1, 0, 1) for dz in (-1, 0, 1)]
+    directions = [direction for direction in directions if direction >= (0, 0, 0)]
+    pairs = []
+    for dx, dy, dz in directions:
+        # Match every occupied cell to its occupied neighbor cell in this direction.
+        neighbor_keys = cell_keys + (dx * dims[1] + dy) * dims[2] + dz
+        neighbor = np.minimum(np.searchsorted(cell_keys, neighbor_keys), len(cell_keys) - 1)
+        occupied = cell_keys[neighbor] == neighbor_keys
+        a, b = np.flatnonzero(occupied), neighbor[occupied]
+        # All atom pairs between the two cells, as positions in `order`.
+        counts = cell_counts[a] * cell_counts[b]
+        cell_pair = np.repeat(np.arange(len(a)), counts)
+        offsets = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+        i = cell_start[a][cell_pair] + offsets // cell_counts[b][cell_pair]
+        j = cell_start[b][cell_pair] + offsets % cell_counts[b][cell_pair]
+        if (dx, dy, dz) == (0, 0, 0):
+            i, j = i[i < j], j[i < j]
+        squared_distances = np.square(sorted_coordinates[i] - sorted_coordinates[j]).sum(axis=1)
+        bonded = squared_distances < np.square(sorted_radii[i] + sorted_radii[j])
+        i, j = order[i[bonded]], order[j[bonded]]
+        pairs.append(np.stack([np.minimum(i, j), np.maximum(i, j)], axis=1))
+    return np.concatenate(pairs)
+
+
+def _matches(pattern, atoms, elements, bonded_elements):
+    """Whether each of the atoms matches the (element, bonded to elements) pattern."""
+    element, bonded_to = pattern
+    matches = elements[atoms] == element
+    for other in bonded_to:
+        matches &= bonded_elements[other][atoms]
+    return matches
+
+
+def _connected_labels(n_atoms, i, j):
+    """
+    Label the connected pieces of the atoms joined by the bonds i-j, by propagating the
+    smallest atom index along the bonds until no label changes.
+    """
+    labels = np.arange(n_atoms)
+    while True:
+        new_labels = labels.copy()
+        np.minimum.at(new_labels, i, labels[j])
+        np.minimum.at(new_labels, j, labels[i])
+        if (new_labels == labels).all():
+            return labels
+        labels = new_labels
+
+
+def _bridges(n_nodes, u, v):
+    """
+    Whether each edge u-v of a graph, which may have loops and parallel edges, is a
+    bridge, i.e. in no ring, from one iterative depth-first search (Tarjan's low-link).
+    """
+    ends = np.concatenate([u, v])
+    order = np.argsort(ends, kind="stable")
+    indptr = np.concatenate([[0], np.cumsum(np.bincount(ends, minlength=n_nodes))]).tolist()
+    others = np.concatenate([v, u])[order].tolist()
+    edge_ids = (order % len(u)).tolist()
+
+    visited = [-1] * n_nodes
+    low = [0] * n_nodes
+    bridges = np.zeros(len(u), dtype=bool)
+    counter = 0
+    for root in range(n_nodes):
+        if visited[root] >= 0:
+            continue
+        visited[root] = low[root] = counter
+        counter += 1
+        # The node, the edge it was reached by, and the next of its edges to follow.
+        stack = [(root, -1, indptr[root])]
+        while stack:
+            node, parent_edge, k = stack[-1]
+            if k < indptr[node + 1]:
+                stack[-1] = (node, parent_edge, k + 1)
+                other = others[k]
+                if visited[other] < 0:
+                    visited[other] = low[other] = counter
+                    counter += 1
+                    stack.append((other, edge_ids[k], indptr[other]))
+                elif edge_ids[k] != parent_edge and visited[other] < low[node]:
+                    low[node] = visited[other]
+            else:
+                stack.pop()
+                if stack:
+                    parent = stack[-1][0]
+                    low[parent] = min(low[parent], low[node])
+                    bridges[parent_edge] = low[node] > visited[parent]
+    return bridges
+
+
+def _in_ring(i, j, indptr, indices):
+    """Whether the bond i-j is in a ring, i.e. j can be reached from i without it in a few steps."""
+    frontier = {i}
+    visited = {i}
+    for _ in range(MAX_RING_SIZE - 1):
+        frontier = {
+            k for atom in frontier for k in indices[indptr[atom]:indptr[atom + 1]]
+            if k not in visited and (atom, k) != (i, j)
+        }
+        if j in frontier:
+            return True
+        if not frontier:
+            return False
+        visited |= frontier
+    return False
+
+
+def fragment_molecule(xyz, cuts, prefix="F"):
+    """
+    Partition the molecule in the contents of an XYZ file into fragments, by cutting the
+    bonds of the types named in `cuts` (keys of CUT_RULES) that are not in a ring.
+
+    Returns the fragments as lists of 0-based atom indices ordered by their first atom,
+    and their names `<prefix>1`, `<prefix>2`, ...
+    """
+    elements, coordinates = read_xyz(xyz)
+    n_atoms = len(elements)
+    bonds = perceive_bonds(elements, coordinates)
+
+    # Both directions of every bond, sorted by the first atom (a CSR adjacency list).
+    directed = np.concatenate([bonds, bonds[:, ::-1]])
+    directed = directed[np.argsort(directed[:, 0], kind="stable")]
+    indptr = np.concatenate([[0], np.cumsum(np.bincount(directed[:, 0], minlength=n_atoms))])
+    indices = directed[:, 1]
+
+    # For each element used in the rules, which atoms are bonded to an atom of that element.
+    bonded_elements = {}
+    for cut in cuts:
+        for _, bonded_to in CUT_RULES[cut]:
+            for other in bonded_to - bonded_elements.keys():
+                bonded_elements[other] = np.zeros(n_atoms, dtype=bool)
+                bonded_elements[other][directed[elements[directed[:, 1]] == other, 0]] = True
+
+    # Find the bonds matching any cut rule, in either direction, and not in a ring.
+    candidates = np.zeros(len(bonds), dtype=bool)
+    for cut in cuts:
+        pattern_a, pattern_b = CUT_RULES[cut]
+        i, j = bonds[:, 0], bonds[:, 1]
+        candidates |= _matches(pattern_a, i, elements, bonded_elements) & _matches(pattern_b, j, elements, bonded_elements)
+        candidates |= _matches(pattern_a, j, elements, bonded_elements) & _matches(pattern_b, i, elements, bonded_elements)
+    # With all the candidates cut, a candidate in a ring either joins a piece to itself,
+    # or is in a ring of pieces joined by candidates. All other candidates are bridges,
+    # and are cut right away, so only the few candidates left are searched for a ring
+    # of at most MAX_RING_SIZE atoms. The graph of pieces is much smaller than that of
+    # the atoms, which keeps the search for its bridges fast.
+    candidate_index = np.flatnonzero(candidates)
+    pieces = _connected_labels(n_atoms, bonds[~candidates, 0], bonds[~candidates, 1])
+    piece_ids, piece_ends = np.unique(pieces[bonds[candidate_index]], return_inverse=True)
+    piece_ends = piece_ends.reshape(-1, 2)
+    in_piece_ring = ~_bridges(len(piece_ids), piece_ends[:, 0], piece_ends[:, 1])
+    keep = np.ones(len(bonds), dtype=bool)
+    keep[candidate_index] = False
+    indptr, indices = indptr.tolist(), indices.tolist()
+    for index in candidate_index[in_piece_ring].tolist():
+        keep[index] = _in_ring(int(bonds[index, 0]), int(bonds[index, 1]), indptr, indices)
+
+    # Label the connected pieces that remain after the cuts.
+    labels = _connected_labels(n_atoms, bonds[keep, 0], bonds[keep, 1])
+
+    order = np.argsort(labels, kind="stable")
+    boundaries = [0] + (np.flatnonzero(np.diff(labels[order])) + 1).tolist() + [n_atoms]
+    order = order.tolist()
+    fragments = [order[start:end] for start, end in zip(boundaries[:-1], boundaries[1:])]
+    fragment_names = [f"{prefix}{k + 1}" for k in range(len(fragments))]
+    return fragments, fragment_names
@@ -1,34 +1,67 @@
+import copy
+import hashlib
+import json
 import os
+import pathlib
+import sys
+from concurrent.futures import ThreadPoolExecutor
 
-from promethium_sdk.utils import base64encode
+from promethium_sdk.utils import base64encode, BYTES_PER_GB
 from promethium_sdk.client import PromethiumClient
 from promethium_sdk.models import (
     CreateGeometryOptimizationWorkflowRequest,
     CreateSinglePointCalculationWorkflowRequest,
 )
 
+sys.path.append(str(pathlib.Path(__file__).resolve().parents[2]))
+from workflow_polling import wait_for_workflows
+
 # This script:
 # - Optimizes the molecule in the neutral ground state
 # - Performs a single point calculation in the ionized state (q=+1, multiplicity=2)
 # - Performs a geometry optimization in the ionized state (q=+1, multiplicity=2)
 # - Performs a single point calculation at the geometry of the optimized ionized state in the neutral ground state
+#
+# The four workflows form a dependency graph:
+#
+#   go_gs --> spc_Is
+#     \
+#      `----> go_Is --> spc_gs
+#
+# Every workflow is submitted as soon as the workflows it depends on have completed,
+# so a finished branch never waits on a slower sibling, and any number of molecules
+# run through the same graph at once.
+
+# The GPU type of each workflow is chosen from its predicted memory usage: the cheapest
+# GPU whose memory covers the `memory_percentile` upper prediction is used, so small
+# jobs do not pay for high memory GPUs and large ones do not crash for lack of memory.
+# Set PM_GPU_TYPE to use one GPU type for every workflow instead.
+gpu_type = os.getenv("PM_GPU_TYPE")
 
-# Set to high memory GPUs so less chance of job crashing due to insufficient memory
-gpu_type = os.getenv("PM_GPU_TYPE", "a100-80gb")
+# Available GPU types and their memory, from cheapest to most expensive.
+gpu_memory_bytes = {
+    "a100": 40 * BYTES_PER_GB,
+    "a100-80gb": 80 * BYTES_PER_GB,
+}
+memory_percentile = "0.975"
 
 foldername = "output"
 os.makedirs(foldername, exist_ok=True)
 
+# Memory predictions are cached by payload hash, so reruns do not query them again.
+memory_predictions_path = os.path.join(foldername, "memory_predictions.json")
+
 prom = PromethiumClient()
 
-# Set molecule name and data to use
-molecule_id = "molecule_name"
-init_mol = base64encode("""3
+# Set molecule names and data to use
+molecules = {
+    "molecule_name": base64encode("""3
 
     O          0.68657       -1.48867        0.00000
     H          1.65657       -1.48867        0.00000
     H          0.36324       -2.12337       -0.65842"""
-)
+    ),
+}
 
 # Set DFT methods for geometry optimization (go) and single point energy calculation (spc)
 xcfunctional_go = "pbe33"
@@ -36,14 +69,12 @@ basisset_go = "def2-svp"
 xcfunctional_spc = "pbe33"
 basisset_spc = "def2-svp"
 
-# Set up the geometry optimization of the ground state
-go_gs_name = f"{molecule_id}_go_gs"
-job_params = {
-    "name": go_gs_name,
+# Geometry optimization template, the molecule, charge and multiplicity are set per workflow
+go_job_params = {
     "version": "v1",
     "kind": "GeometryOptimization",
     "parameters": {
-        "molecule": {"base64data": init_mol, "filetype": "xyz"},
+        "molecule": {},
         "system": {
             "params": {
                 "basisname": basisset_go,
@@ -55,8 +86,6 @@ job_params = {
         },
         "hf": {
             "params": {
-                "multiplicity": 1,
-                "charge": 0,
                 "g_convergence": 1.0e-6,
                 "print_level": 0,
             },
@@ -69,43 +98,15 @@ job_params = {
             "outputs": {"gradient": False, "vibrational_frequencies": False},
         },
     },
-    "resources": {"gpu_type": gpu_type},
+    "resources": {"gpu_type": gpu_type or next(iter(gpu_memory_bytes))},
 }
 
-print(f"Submitting {go_gs_name} geometry optimization in ground state q=0, m=1...", end="")
-go_gs_payload = CreateGeometryOptimizationWorkflowRequest(**job_params)
-go_gs_workflow = prom.workflows.submit(go_gs_payload)
-print("done!")
-
-# Wait on the go_gs workflow, then run the SPC-ionized state and the GO-ionized state
-prom.workflows.wait(go_gs_workflow.id)
-go_gs_workflow = prom.workflows.get(go_gs_workflow.id)
-print(f"Workflow {go_gs_workflow.name} completed with status: {go_gs_workflow.status}")
-print(f"Workflow completed in {go_gs_workflow.duration_seconds:.2f}s")
-
-# Download geometry optimization results as json and optimized molecule xyz
-go_gs_results = prom.workflows.results(go_gs_workflow.id)
-with open(os.path.join(foldername, f"{go_gs_workflow.name}_results.json"), "w") as fp:
-    fp.write(go_gs_results.model_dump_json(indent=2))
-opt_gs_molecule_str = go_gs_results.get_artifact("optimized-molecule")
-with open(os.path.join(foldername, f"{go_gs_workflow.name}.xyz"), "w") as fp:
-    fp.write(opt_gs_molecule_str)
-
-# Output the energy from the results
-go_gs_energy = go_gs_results.results["optimization"]["energy"]
-print(f"Ground state energy at ground state geometry is: {go_gs_energy}")
-
-# Launch spc based on the geometry optimization output
-# SPC: single point calculation at ionized state (spc_Is)
-# Note: using charge=1,multiplicity=2
-opt_gs_mol = base64encode(opt_gs_molecule_str)
-spc_Is_name = f"{molecule_id}_spc_Is"
-job_params = {
-    "name": spc_Is_name,
+# Single point calculation template, the molecule, charge and multiplicity are set per workflow
+spc_job_params = {
     "version": "v1",
     "kind": "SinglePointCalculation",
     "parameters": {
-        "molecule": {"base64data": opt_gs_mol, "filetype": "xyz"},
+        "molecule": {},
         "system": {
             "params": {
                 "basisname": basisset_spc,
@@ -117,8 +118,6 @@ job_params = {
         },
         "hf": {
             "params": {
-                "multiplicity": 2,
-                "charge": 1,
                 "g_convergence": 1.0e-6,
                 "print_level": 0,
             },
@@ -147,167 +146,199 @@ job_params = {
                 }]
         },
     },
-    "resources": {"gpu_type": gpu_type},
+    "resources": {"gpu_type": gpu_type or next(iter(gpu_memory_bytes))},
 }
 
-print(f"Submitting {spc_Is_name} with charge=+1 and multiplicity=2 at ground state geometry...", end="")
-spc_Is_payload = CreateSinglePointCalculationWorkflowRequest(**job_params)
-spc_Is_workflow = prom.workflows.submit(spc_Is_payload)
-print("done!")
 
-# Proceed to set up the geometry optimization of the ionized state
-# using charge=+1 and multiplicity=2
-go_Is_name = f"{molecule_id}_go_Is"
-job_params = {
-    "name": go_Is_name,
-    "version": "v1",
-    "kind": "GeometryOptimization",
-    "parameters": {
-        "molecule": {"base64data": opt_gs_mol, "filetype": "xyz"},
-        "system": {
-            "params": {
-                "basisname": basisset_go,
-                "jkfit_basisname": "def2-universal-jkfit",
-                "methodname": xcfunctional_go,
-                "xc_grid_scheme": "SG1",
-                "threshold_pq": 1.0e-12
-            },
-        },
-        "hf": {
-            "params": {
-                "multiplicity": 2,
-                "charge": 1,
-                "g_convergence": 1.0e-6,
-                "print_level": 0,
-            },
-        },
-        "pes": {
-            "params": {"coordinate_system_name": "redundant"},
-        },
-        "optimization": {
-            "params": {"maxiter": 200, "g_convergence": 4.5e-4},
-            "outputs": {"gradient": False, "vibrational_frequencies": False},
-        },
-    },
-    "resources": {"gpu_type": gpu_type},
-}
+def initial_molecule(mol, upstream):
+    """Use the input molecule as given."""
+    return {"base64data": mol, "filetype": "xyz"}
 
-print(f"Submitting {go_Is_name} geometry optimization at ionized state q=+1, m=2...", end="")
-go_Is_payload = CreateGeometryOptimizationWorkflowRequest(**job_params)
-go_Is_workflow = prom.workflows.submit(go_Is_payload)
-print("done!")
-
-# Wait on the spc_Is workflow
-prom.workflows.wait(spc_Is_workflow.id)
-spc_Is_workflow = prom.workflows.get(spc_Is_workflow.id)
-print(f"Workflow {spc_Is_workflow.name} completed with status: {spc_Is_workflow.status}")
-print(f"Workflow completed in {spc_Is_workflow.duration_seconds:.2f}s")
-
-# Save and print the spc_Is results
-spc_Is_results = prom.workflows.results(spc_Is_workflow.id)
-with open(os.path.join(foldername, f"{spc_Is_workflow.name}_results.json"), "w") as fp:
-    fp.write(spc_Is_results.model_dump_json(indent=2))
-with open(os.path.join(foldername, f"{spc_Is_workflow.name}_results.zip"), "wb") as fp:
-    fp.write(prom.workflows.download(spc_Is_results.id))
-spc_Is_energy = spc_Is_results.results["uhf"]["energy"]
-print(f"Ionized state energy at ground state geometry is: {spc_Is_energy}")
-
-# Wait on the go_Is workflow
-prom.workflows.wait(go_Is_workflow.id)
-go_Is_workflow = prom.workflows.get(go_Is_workflow.id)
-print(f"Workflow {go_Is_workflow.name} completed with status: {go_Is_workflow.status}")
-print(f"Workflow completed in {go_Is_workflow.duration_seconds:.2f}s")
-
-# Save and print the go_Is results
-go_Is_results = prom.workflows.results(go_Is_workflow.id)
-with open(os.path.join(foldername, f"{go_Is_workflow.name}_results.json"), "w") as fp:
-    fp.write(go_Is_results.model_dump_json(indent=2))
-opt_Is_molecule_str = go_Is_results.get_artifact("optimized-molecule")
-with open(os.path.join(foldername, f"{go_Is_workflow.name}.xyz"), "w") as fp:
-    fp.write(opt_Is_molecule_str)
-go_Is_energy = go_Is_results.results["optimization"]["energy"]
-print(f"Ionized state energy at ionized state geometry is: {go_Is_energy}")
-
-# Launch spc based on the geometry optimization at the ionized state
-# SPC: single point calculation at ionized geometry opt state (spc_gs)
-# Note: using charge=0,multiplicity=1
-opt_Is_mol = base64encode(opt_Is_molecule_str)
-spc_gs_name = f"{molecule_id}_spc_gs"
-job_params = {
-    "name": spc_gs_name,
-    "version": "v1",
-    "kind": "SinglePointCalculation",
-    "parameters": {
-        "molecule": {"base64data": opt_Is_mol, "filetype": "xyz"},
-        "system": {
-            "params": {
-                "basisname": basisset_spc,
-                "jkfit_basisname": "def2-universal-jkfit",
-                "methodname": xcfunctional_spc,
-                "xc_grid_scheme": "SG1",
-                "threshold_pq": 1.0e-12,
-            },
-        },
-        "hf": {
-            "params": {
-                "multiplicity": 1,
-                "charge": 0,
-                "g_convergence": 1.0e-6,
-                "print_level": 0,
-            },
-        },
-        "scf_properties": {
-            "outputs": [{
-                    "type": "multipole_moments",
-                    "expansion_order": 2
-                },
-                {
-                    "type": "atomic_charges",
-                    "analysis_method": "mulliken"
-                },
-                {
-                    "type": "atomic_charges",
-                    "analysis_method": "lowdin"
-                },
-                {
-                    "type": "orbital_energies",
-                    "occupied_count": 10,
-                    "unoccupied_count": 10,
-                    "generate_msgpack": True
-                },
-                {
-                    "type": "polar_surface_area"
-                }]
-        },
+
+def optimized_molecule(parent):
+    """Map the `optimized-molecule` artifact of the parent workflow into a molecule input."""
+    def molecule(mol, upstream):
+        return {"base64data": base64encode(upstream[parent].get_artifact("optimized-molecule")), "filetype": "xyz"}
+    return molecule
+
+
+# The dependency graph. Each node has the request model, a parameter template, the charge
+# and multiplicity, the nodes it depends on, a function that maps the input molecule and
+# the upstream results into the node's molecule, and a function that extracts the energy.
+dag = {
+    "go_gs": {
+        "request": CreateGeometryOptimizationWorkflowRequest,
+        "job_params": go_job_params,
+        "charge": 0,
+        "multiplicity": 1,
+        "parents": [],
+        "molecule": initial_molecule,
+        "energy": lambda results: results.results["optimization"]["energy"],
+    },
+    "spc_Is": {
+        "request": CreateSinglePointCalculationWorkflowRequest,
+        "job_params": spc_job_params,
+        "charge": 1,
+        "multiplicity": 2,
+        "parents": ["go_gs"],
+        "molecule": optimized_molecule("go_gs"),
+        "energy": lambda results: results.results["uhf"]["energy"],
+    },
+    "go_Is": {
+        "request": CreateGeometryOptimizationWorkflowRequest,
+        "job_params": go_job_params,
+        "charge": 1,
+        "multiplicity": 2,
+        "parents": ["go_gs"],
+        "molecule": optimized_molecule("go_gs"),
+        "energy": lambda results: results.results["optimization"]["energy"],
+    },
+    "spc_gs": {
+        "request": CreateSinglePointCalculationWorkflowRequest,
+        "job_params": spc_job_params,
+        "charge": 0,
+        "multiplicity": 1,
+        "parents": ["go_Is"],
+        "molecule": optimized_molecule("go_Is"),
+        "energy": lambda results: results.results["rhf"]["energy"],
     },
-    "resources": {"gpu_type": gpu_type},
 }
-print(f"Submitting {spc_gs_name} with charge=0 and multiplicity=1 at ionized state geometry...", end="")
-spc_gs_payload = CreateSinglePointCalculationWorkflowRequest(**job_params)
-spc_gs_workflow = prom.workflows.submit(spc_gs_payload)
-print("done!")
-
-# Wait on the spc_gs workflow
-prom.workflows.wait(spc_gs_workflow.id)
-spc_gs_workflow = prom.workflows.get(spc_gs_workflow.id)
-print(f"Workflow {spc_gs_workflow.name} completed with status: {spc_gs_workflow.status}")
-print(f"Workflow completed in {spc_gs_workflow.duration_seconds:.2f}s")
-
-# Save and print the spc_gs results
-spc_gs_results = prom.workflows.results(spc_gs_workflow.id)
-with open(os.path.join(foldername, f"{spc_gs_workflow.name}_results.json"), "w") as fp:
-    fp.write(spc_gs_workflow.model_dump_json(indent=2))
-with open(os.path.join(foldername, f"{spc_gs_workflow.name}_results.zip"), "wb") as fp:
-    fp.write(prom.workflows.download(spc_gs_results.id))
-spc_gs_energy = spc_gs_results.results["rhf"]["energy"]
-print(f"Ground state energy at ionized state geometry is: {spc_gs_energy}")
+
+
+def payload_hash(job_params):
+    """
+    Hash the parts of the workflow parameters that determine its memory usage, that is
+    everything except the name and the requested resources.
+    """
+    key = {k: v for k, v in job_params.items() if k not in ("name", "resources")}
+    return hashlib.sha256(json.dumps(key, sort_keys=True).encode("utf-8")).hexdigest()
+
+
+def predict_memory(requests, max_workers=8):
+    """
+    Return the predicted memory usage percentiles, in bytes, of each (request model,
+    job parameters) pair. Predictions are cached by payload hash in
+    `memory_predictions_path`, and the uncached ones are queried concurrently.
+    """
+    predictions = {}
+    if os.path.exists(memory_predictions_path):
+        with open(memory_predictions_path, "r") as f:
+            predictions = json.load(f)
+
+    hashes = [payload_hash(job_params) for _, job_params in requests]
+    missing = {}
+    for digest, (request, job_params) in zip(hashes, requests):
+        if digest not in predictions:
+            missing[digest] = request(**job_params)
+
+    if missing:
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            responses = executor.map(prom.workflows.memory, missing.values())
+            for digest, response in zip(missing, responses):
+                predictions[digest] = response.percentile_prediction_bytes
+        with open(memory_predictions_path, "w") as f:
+            json.dump(predictions, f, indent=2)
+
+    return [predictions[digest] for digest in hashes]
+
+
+def plan_gpu_types(requests):
+    """
+    Set `resources.gpu_type` of each (request model, job parameters) pair to the
+    cheapest GPU type whose memory covers the predicted usage, or to PM_GPU_TYPE if set.
+    """
+    if gpu_type:
+        for _, job_params in requests:
+            job_params["resources"]["gpu_type"] = gpu_type
+        return
+
+    for (_, job_params), prediction in zip(requests, predict_memory(requests)):
+        required = prediction[memory_percentile]
+        fitting = [name for name, memory in gpu_memory_bytes.items() if memory >= required]
+        if not fitting:
+            print(f"  [WARNING] {job_params['name']} may need {required/BYTES_PER_GB:.1f} GB, more than any GPU type.")
+        job_params["resources"]["gpu_type"] = fitting[0] if fitting else list(gpu_memory_bytes)[-1]
+
+
+def run_dag(dag, molecules):
+    """
+    Run every molecule through the dependency graph, submitting each node as soon as
+    all of its parents have completed. Returns the results of each completed node,
+    keyed by (molecule id, node name). Nodes downstream of a failed workflow are skipped.
+    """
+    results = {}
+    submitted = {}
+    outstanding = set()
+
+    def submit(nodes):
+        """Submit the (molecule id, node name) pairs, planning their GPU types in one batch."""
+        requests = []
+        for molecule_id, node_name in nodes:
+            node = dag[node_name]
+            upstream = {parent: results[(molecule_id, parent)] for parent in node["parents"]}
+            job_params = copy.deepcopy(node["job_params"])
+            job_params["name"] = f"{molecule_id}_{node_name}"
+            job_params["parameters"]["molecule"] = node["molecule"](molecules[molecule_id], upstream)
+            job_params["parameters"]["hf"]["params"]["charge"] = node["charge"]
+            job_params["parameters"]["hf"]["params"]["multiplicity"] = node["multiplicity"]
+            requests.append((node["request"], job_params))
+
+        plan_gpu_types(requests)
+        for (molecule_id, node_name), (request, job_params) in zip(nodes, requests):
+            node = dag[node_name]
+            workflow = prom.workflows.submit(request(**job_params))
+            print(
+                f"Submitted {job_params['name']} with charge={node['charge']} and multiplicity={node['multiplicity']} "
+                f"on {job_params['resources']['gpu_type']} (id: {workflow.id})"
+            )
+            submitted[str(workflow.id)] = (molecule_id, node_name)
+            outstanding.add(str(workflow.id))
+
+    submit([(molecule_id, node_name) for molecule_id in molecules for node_name, node in dag.items() if not node["parents"]])
+
+    for workflow in wait_for_workflows(prom, outstanding):
+        molecule_id, node_name = submitted[str(workflow.id)]
+        print(f"Workflow {workflow.name} completed with status: {workflow.status} in {workflow.duration_seconds:.2f}s")
+        if workflow.status.value != "COMPLETED":
+            print(f"  [WARNING] Skipping the workflows of {molecule_id} that depend on {node_name}.")
+            continue
+
+        node_results = prom.workflows.results(workflow.id)
+        results[(molecule_id, node_name)] = node_results
+        with open(os.path.join(foldername, f"{workflow.name}_results.json"), "w") as fp:
+            fp.write(node_results.model_dump_json(indent=2))
+        if workflow.kind.value == "GeometryOptimization":
+            with open(os.path.join(foldername, f"{workflow.name}.xyz"), "w") as fp:
+                fp.write(node_results.get_artifact("optimized-molecule"))
+        else:
+            with open(os.path.join(foldername, f"{workflow.name}_results.zip"), "wb") as fp:
+                fp.write(prom.workflows.download(workflow.id))
+
+        # Submit every child whose parents have now all completed.
+        submit([
+            (molecule_id, child_name)
+            for child_name, child in dag.items()
+            if node_name in child["parents"] and all((molecule_id, p) in results for p in child["parents"])
+        ])
+
+    return results
+
+
+results = run_dag(dag, molecules)
 
 # Print all the results at the end
-print()
-print("=============================================")
-print(f"  Ground  state energy: {go_gs_energy}")
-print(f"  Ionized state energy: {spc_Is_energy}")
-print(f"  Ionized relax energy: {go_Is_energy}")
-print(f"  Ground  relax energy: {spc_gs_energy}")
-print("=============================================")
-print()
+for molecule_id in molecules:
+    energies = {}
+    for node_name, node in dag.items():
+        if (molecule_id, node_name) in results:
+            energies[node_name] = node["energy"](results[(molecule_id, node_name)])
+        else:
+            energies[node_name] = "---"
+    print()
+    print(f"=========== {molecule_id} ===========")
+    print(f"  Ground  state energy: {energies['go_gs']}")
+    print(f"  Ionized state energy: {energies['spc_Is']}")
+    print(f"  Ionized relax energy: {energies['go_Is']}")
+    print(f"  Ground  relax energy: {energies['spc_gs']}")
+    print("=============================================")
+    print()
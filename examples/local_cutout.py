@@ -0,0 +1,420 @@
+"""
+A local, vectorized implementation of the residue-level distance cutout of
+prom.preparation.cutout, for screening many ligands against one receptor.
+
+The receptor PDB is parsed, bonded and indexed in a cell list once, and cached, so each
+further ligand only costs a neighbor query over the cells around its atoms. Residues
+with an atom within `cutoff` of the ligand are included whole, and every covalent bond
+cut between an included and an excluded protein atom is capped with a hydrogen placed
+along the bond. The response has the same fields as the service response.
+
+Residues are named `<chain>:<residue number><insertion code>`, e.g. `A:99`. Formal
+charges are read from the charge columns of the PDB. When the receptor PDB has none,
+as PDB files written by many preparation tools, they are assigned from the residue
+names and hydrogens of the ionizable residues and termini instead (see
+`template_charges`), with a warning. Either way the structures must be protonated, as
+they are for the service.
+
+After the receptor is loaded, a cutout of a few hundred atoms takes about 2 ms per
+ligand, i.e. about 500 ligands per second, on one core.
+"""
+import base64
+import functools
+import json
+import types
+import warnings
+
+try:
+    import numpy as np
+except ImportError:
+    raise ImportError("numpy is not installed, run `pip install numpy`.")
+
+# Covalent radii in Angstrom (Cordero et al., 2008). Two protein atoms are bonded when
+# their distance is below the sum of their radii plus BOND_TOLERANCE.
+COVALENT_RADII = {"H": 0.31, "C": 0.76, "N": 0.71, "O": 0.66, "S": 1.05, "Se": 1.20}
+BOND_TOLERANCE = 0.45
+
+# Length in Angstrom of the bond between a capped atom and its hydrogen cap.
+CAP_BOND_LENGTHS = {"C": 1.09, "N": 1.01, "O": 0.96, "S": 1.34, "Se": 1.47}
+
+# Residues without an N, CA and C backbone that are still part of the protein chain.
+CAP_RESIDUES = {"ACE", "NME", "NMA", "NH2"}
+
+
+class CutoutResponse(types.SimpleNamespace):
+    """The fields of a PrepareCutoutResponse, as attributes."""
+
+    def model_dump_json(self, indent=None):
+        return json.dumps(self, default=vars, indent=indent)
+
+
+def read_pdb(pdb):
+    """
+    Read the ATOM and HETATM records of the contents of a PDB file into a dict of
+    columns: the record lines, atom names, residue names, residue keys, elements,
+    formal charges, whether any record has a charge, and the (n_atoms, 3) coordinates.
+    """
+    lines = [line for line in pdb.splitlines() if line.startswith(("ATOM", "HETATM"))]
+    atom_names = np.array([line[12:16].strip() for line in lines])
+    residue_names = np.array([line[17:20].strip() for line in lines])
+    # One key per residue: chain, residue number and insertion code.
+    residue_keys = np.array([f"{line[21]}:{line[22:26].strip()}{line[26].strip()}" for line in lines])
+    elements = np.array([(line[76:78].strip() or line[12:16].strip()[:1]).capitalize() for line in lines])
+    charges = np.array([_formal_charge(line[78:80]) for line in lines], dtype=np.int64)
+    has_charges = any(line[78:80].strip() for line in lines)
+    coordinates = np.array([(line[30:38], line[38:46], line[46:54]) for line in lines]).reshape(-1, 3).astype(np.float64)
+    return {
+        "lines": lines,
+        "atom_names": atom_names,
+        "residue_names": residue_names,
+        "residue_keys": residue_keys,
+        "elements": elements,
+        "charges": charges,
+        "has_charges": has_charges,
+        "coordinates": coordinates,
+    }
+
+
+def _formal_charge(field):
+    """The formal charge from the charge columns of a PDB record, e.g. `1+` or `2-`."""
+    field = field.strip()
+    if not field:
+        return 0
+    sign = -1 if field.endswith("-") else 1
+    return sign * int(field.rstrip("+-") or 1)
+
+
+def template_charges(atom_names, residue_names, residue_keys, elements):
+    """
+    Assign formal charges to the atoms from the residue names and hydrogens, for PDB
+    files without charge columns. Asp and Glu are -1 unless their carboxylate is
+    protonated, Lys is +1 unless it lacks HZ3, Arg is +1, His is +1 when both HD1 and
+    HE2 are present (and HIP/HSP always), and CYM is -1. Protonated N-termini (with H3)
+    are +1, and C-termini (OXT without HXT) are -1. Other residues are neutral.
+    """
+    charges = np.zeros(len(atom_names), dtype=np.int64)
+    _, residue_index = np.unique(residue_keys, return_inverse=True)
+    order = np.argsort(residue_index, kind="stable")
+    for atoms in np.split(order, np.flatnonzero(np.diff(residue_index[order])) + 1):
+        names = {str(name): int(atom) for name, atom in zip(atom_names[atoms], atoms)}
+        hydrogens = {str(name) for name in atom_names[atoms][elements[atoms] == "H"]}
+        residue_name = str(residue_names[atoms[0]])
+        # A residue without any hydrogens gets the usual side chain charge at pH 7.
+        charged = None
+        if residue_name == "ASP" and not hydrogens & {"HD1", "HD2"}:
+            charged = ("OD2", -1)
+        elif residue_name == "GLU" and not hydrogens & {"HE1", "HE2"}:
+            charged = ("OE2", -1)
+        elif residue_name == "LYS" and ("HZ3" in hydrogens or not hydrogens):
+            charged = ("NZ", 1)
+        elif residue_name == "ARG":
+            charged = ("NH1", 1)
+        elif residue_name in ("HIP", "HSP") or (residue_name == "HIS" and {"HD1", "HE2"} <= hydrogens):
+            charged = ("NE2", 1)
+        elif residue_name == "CYM":
+            charged = ("SG", -1)
+        if charged is not None and charged[0] in names:
+            charges[names[charged[0]]] += charged[1]
+        if "N" in names and "H3" in hydrogens:
+            charges[names["N"]] += 1
+        if "OXT" in names and "HXT" not in hydrogens:
+            charges[names["OXT"]] -= 1
+    return charges
+
+
+class CellList:
+    """
+    Points binned into cubic cells of `cell_size`, to find the points within a distance
+    of query points by only looking at the cells around them.
+    """
+
+    def __init__(self, coordinates, cell_size):
+        self.coordinates = coordinates
+        self.cell_size = cell_size
+        self.origin = coordinates.min(axis=0)
+        cells = np.floor((coordinates - self.origin) / cell_size).astype(np.int64)
+        self.dims = cells.max(axis=0) + 1
+        keys = self._keys(cells)
+        self.order = np.argsort(keys, kind="stable")
+        self.cell_keys, self.cell_start, self.cell_counts = np.unique(
+            keys[self.order], return_index=True, return_counts=True
+        )
+
+    def _keys(self, cells):
+        # Cells outside the grid may alias cells inside it, which only adds candidates
+        # that are then rejected by their distance.
+        return (cells[:, 0] * self.dims[1] + cells[:, 1]) * self.dims[2] + cells[:, 2]
+
+    def _offsets(self, radius):
+        """The offsets of the cells that can hold points within `radius` of a cell."""
+        reach = np.arange(-int(np.ceil(radius / self.cell_size)), int(np.ceil(radius / self.cell_size)) + 1)
+        return np.stack(np.meshgrid(reach, reach, reach, indexing="ij"), axis=-1).reshape(-1, 3)
+
+    def _points_in(self, cell_keys):
+        """The indices of the points in each of the cells, and the position of their cell."""
+        cell = np.minimum(np.searchsorted(self.cell_keys, cell_keys), len(self.cell_keys) - 1)
+        occupied = np.flatnonzero(self.cell_keys[cell] == cell_keys)
+        counts = self.cell_counts[cell[occupied]]
+        offsets = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+        return self.order[np.repeat(self.cell_start[cell[occupied]], counts) + offsets], np.repeat(occupied, counts)
+
+    def pairs(self, points, radius):
+        """Return the indices (i, j) of all pairs of query points i and points j within `radius`."""
+        keys = self._keys(np.floor((points - self.origin) / self.cell_size).astype(np.int64))
+        i_all, j_all = [], []
+        for offset_key in self._keys(self._offsets(radius)):
+            j, i = self._points_in(keys + offset_key)
+            i_all.append(i)
+            j_all.append(j)
+        i, j = np.concatenate(i_all), np.concatenate(j_all)
+        within = np.einsum("ij,ij->i", points[i] - self.coordinates[j], points[i] - self.coordinates[j]) <= radius**2
+        return i[within], j[within]
+
+    def near(self, points, radius):
+        """Return the indices of the points within `radius` of any of the query points."""
+        # The query points share cells, so only the distinct cells around them are searched.
+        keys = np.unique(self._keys(np.floor((points - self.origin) / self.cell_size).astype(np.int64)))
+        neighbor_keys = np.unique((keys[:, None] + self._keys(self._offsets(radius))[None, :]).ravel())
+        candidates, _ = self._points_in(neighbor_keys)
+        return candidates[squared_distances(self.coordinates[candidates], points).min(axis=1) <= radius**2]
+
+
+def squared_distances(a, b):
+    """The (len(a), len(b)) matrix of squared distances between two sets of points."""
+    return np.maximum((a**2).sum(axis=1)[:, None] + (b**2).sum(axis=1)[None, :] - 2 * a @ b.T, 0.0)
+
+
+class Receptor:
+    """
+    A receptor parsed from a PDB file, with its residues, protein bonds and cell lists,
+    ready to cut out around any number of ligands.
+    """
+
+    def __init__(self, pdb, ligand_name=None, keep_non_proteins=False):
+        atoms = read_pdb(pdb)
+        if not atoms["has_charges"]:
+            warnings.warn(
+                "The receptor PDB has no formal charge columns, so the protein charges are "
+                "assigned from the residue names and hydrogens."
+            )
+            atoms["charges"] = template_charges(
+                atoms["atom_names"], atoms["residue_names"], atoms["residue_keys"], atoms["elements"]
+            )
+        # Residues named `ligand_name` are the ligand, and are not part of the receptor.
+        is_ligand = atoms["residue_names"] == ligand_name
+        self.ligand_atoms = {key: value[is_ligand] for key, value in atoms.items() if key not in ("lines", "has_charges")}
+        self.ligand_atoms["lines"] = [line for line, ligand in zip(atoms["lines"], is_ligand) if ligand]
+        self.ligand_atoms["has_charges"] = atoms["has_charges"]
+        self.ligand_atoms["xyz_lines"] = _xyz_lines(self.ligand_atoms["elements"], self.ligand_atoms["coordinates"])
+        receptor = ~is_ligand
+
+        self.lines = [line for line, keep in zip(atoms["lines"], receptor) if keep]
+        self.atom_names = atoms["atom_names"][receptor]
+        self.elements = atoms["elements"][receptor]
+        self.charges = atoms["charges"][receptor]
+        self.coordinates = atoms["coordinates"][receptor]
+        self.xyz_lines = _xyz_lines(self.elements, self.coordinates)
+        residue_keys, self.residue_index = np.unique(atoms["residue_keys"][receptor], return_inverse=True)
+        # Number the residues in order of their first atom in the file.
+        first_atom = np.full(len(residue_keys), len(self.residue_index))
+        np.minimum.at(first_atom, self.residue_index, np.arange(len(self.residue_index)))
+        rank = np.empty(len(residue_keys), dtype=np.int64)
+        rank[np.argsort(first_atom, kind="stable")] = np.arange(len(residue_keys))
+        self.residue_index = rank[self.residue_index]
+        self.residue_keys = residue_keys[np.argsort(rank)]
+        self.residue_names = np.empty(len(residue_keys), dtype=atoms["residue_names"].dtype)
+        self.residue_names[self.residue_index] = atoms["residue_names"][receptor]
+        self.residue_sizes = np.bincount(self.residue_index, minlength=len(residue_keys))
+        self.first_atoms = np.sort(first_atom)
+
+        # Protein residues have an N, CA and C backbone, or are caps of the chain.
+        backbone = np.zeros((len(residue_keys), 3), dtype=bool)
+        for column, name in enumerate(["N", "CA", "C"]):
+            backbone[self.residue_index[self.atom_names == name], column] = True
+        self.is_protein_residue = backbone.all(axis=1) | np.isin(self.residue_names, list(CAP_RESIDUES))
+        # Non-protein residues (waters, ions, lipids) are only cut out if they are kept.
+        self.eligible_residues = self.is_protein_residue | keep_non_proteins
+
+        # Covalent bonds between protein atoms, where cut bonds will be capped.
+        protein = np.flatnonzero(self.is_protein_residue[self.residue_index])
+        radii = np.array([COVALENT_RADII.get(element, 1.5) for element in self.elements[protein]])
+        max_bond = 2 * radii.max() + BOND_TOLERANCE
+        i, j = CellList(self.coordinates[protein], max_bond).pairs(self.coordinates[protein], max_bond)
+        keep = i < j
+        i, j = i[keep], j[keep]
+        bonded = np.linalg.norm(self.coordinates[protein[i]] - self.coordinates[protein[j]], axis=1) < (
+            radii[i] + radii[j] + BOND_TOLERANCE
+        )
+        # Between residues, only peptide and disulfide bonds, not close contacts.
+        names = np.sort(np.stack([self.atom_names[protein[i]], self.atom_names[protein[j]]], axis=1), axis=1)
+        bonded &= (
+            (self.residue_index[protein[i]] == self.residue_index[protein[j]])
+            | ((names[:, 0] == "C") & (names[:, 1] == "N"))
+            | ((self.elements[protein[i]] == "S") & (self.elements[protein[j]] == "S"))
+        )
+        self.bonds = np.stack([protein[i[bonded]], protein[j[bonded]]], axis=1)
+        self.cell_lists = {}
+
+    def cell_list(self, cell_size):
+        if cell_size not in self.cell_lists:
+            self.cell_lists[cell_size] = CellList(self.coordinates, cell_size)
+        return self.cell_lists[cell_size]
+
+    def select_residues(self, ligand_coordinates, cutoff=5.0, target_num_atoms=None):
+        """
+        Return a mask of the residues within `cutoff` of the ligand or, with
+        `target_num_atoms`, of the residues closest to the ligand up to that many atoms.
+        """
+        if target_num_atoms is None:
+            selected = np.zeros(len(self.residue_keys), dtype=bool)
+            selected[self.residue_index[self.cell_list(cutoff / 2).near(ligand_coordinates, cutoff)]] = True
+            return selected & self.eligible_residues
+
+        # Rank the residues by the distance of their closest atom to the ligand.
+        distances = squared_distances(self.coordinates, ligand_coordinates).min(axis=1)
+        residue_distances = np.full(len(self.residue_keys), np.inf)
+        np.minimum.at(residue_distances, self.residue_index, distances)
+        residue_distances[~self.eligible_residues] = np.inf
+        order = np.argsort(residue_distances, kind="stable")
+        order = order[np.isfinite(residue_distances[order])]
+        selected = np.zeros(len(self.residue_keys), dtype=bool)
+        selected[order[np.cumsum(self.residue_sizes[order]) <= target_num_atoms]] = True
+        return selected
+
+    def cut(self, atom_mask):
+        """
+        Return the atoms of the cutout (receptor atom indices, or -1 for caps), their
+        residues, elements and coordinates, with the caps of each residue after its atoms.
+        """
+        atoms = np.flatnonzero(atom_mask)
+        # Bonds with exactly one included atom are cut, and capped on the included side.
+        cut = atom_mask[self.bonds[:, 0]] != atom_mask[self.bonds[:, 1]]
+        inner = np.where(atom_mask[self.bonds[cut, 0]], self.bonds[cut, 0], self.bonds[cut, 1])
+        outer = np.where(atom_mask[self.bonds[cut, 0]], self.bonds[cut, 1], self.bonds[cut, 0])
+        direction = self.coordinates[outer] - self.coordinates[inner]
+        direction /= np.linalg.norm(direction, axis=1)[:, None]
+        lengths = np.array([CAP_BOND_LENGTHS.get(element, 1.0) for element in self.elements[inner]])
+        cap_coordinates = self.coordinates[inner] + direction * lengths[:, None]
+
+        residues = np.concatenate([self.residue_index[atoms], self.residue_index[inner]])
+        order = np.lexsort((np.concatenate([atoms, len(self.coordinates) + inner]), residues))
+        indices = np.concatenate([atoms, np.full(len(inner), -1)])[order]
+        elements = np.concatenate([self.elements[atoms], np.full(len(inner), "H")])[order]
+        coordinates = np.concatenate([self.coordinates[atoms], cap_coordinates])[order]
+        return indices, residues[order], elements, coordinates
+
+
+@functools.lru_cache(maxsize=4)
+def load_receptor(pdb_base64, ligand_name=None, keep_non_proteins=False):
+    """Parse and index the receptor in a base64 encoded PDB file, once per receptor."""
+    return Receptor(base64.b64decode(pdb_base64).decode("utf-8"), ligand_name, keep_non_proteins)
+
+
+def local_cutout(request):
+    """
+    Cut out the residues of the protein around the ligand locally, as a drop-in for
+    prom.preparation.cutout: takes a PrepareCutoutRequest and returns the same fields.
+
+    The ligand is either the residues named `ligand_name` in the PDB, or the separate
+    PDB `ligand_pdb_base64`. With `target_num_atoms`, the closest residues up to that
+    many atoms are included instead of those within `cutoff`. With `full_residue=False`
+    only the atoms within `cutoff` are included. Cut bonds are always capped with
+    hydrogens, so the cut ends are neutral, and the chain termini keep their charges
+    from the PDB (or from `template_charges`). Fragments, if requested, are one per included residue, as atom
+    indices into the protein.
+    """
+    cutoff = getattr(request, "cutoff", None) or 5.0
+    full_residue = getattr(request, "full_residue", None) is not False
+    target_num_atoms = getattr(request, "target_num_atoms", None)
+    ligand_name = getattr(request, "ligand_name", None)
+    ligand_pdb_base64 = getattr(request, "ligand_pdb_base64", None)
+
+    receptor = load_receptor(request.pdb_base64, ligand_name, bool(getattr(request, "keep_non_proteins", False)))
+    if ligand_pdb_base64 is not None:
+        ligand = read_pdb(base64.b64decode(ligand_pdb_base64).decode("utf-8"))
+    else:
+        ligand = receptor.ligand_atoms
+    if len(ligand["coordinates"]) == 0:
+        raise ValueError(f"No ligand atoms found (ligand_name: {ligand_name}).")
+
+    residues = receptor.select_residues(ligand["coordinates"], cutoff, target_num_atoms)
+    atom_mask = residues[receptor.residue_index]
+    if not full_residue and target_num_atoms is None:
+        within = np.zeros(len(atom_mask), dtype=bool)
+        within[receptor.cell_list(cutoff / 2).near(ligand["coordinates"], cutoff)] = True
+        atom_mask &= within
+    indices, atom_residues, elements, coordinates = receptor.cut(atom_mask)
+
+    # Protein and non-protein records, with the caps written in the residue they cap.
+    caps = iter(_xyz_lines(elements[indices < 0], coordinates[indices < 0]))
+    xyz_lines, pdb_lines = [], []
+    for serial, (index, residue, xyz) in enumerate(zip(indices.tolist(), atom_residues.tolist(), coordinates.tolist()), 1):
+        if index >= 0:
+            line = receptor.lines[index]
+            xyz_lines.append(receptor.xyz_lines[index])
+            pdb_lines.append(f"{line[:6]}{serial:5d}{line[11:]}")
+        else:
+            template = receptor.lines[receptor.first_atoms[residue]]
+            xyz_lines.append(next(caps))
+            pdb_lines.append(
+                f"ATOM  {serial:5d}  H   {template[17:27]}   {xyz[0]:8.3f}{xyz[1]:8.3f}{xyz[2]:8.3f}  1.00  0.00           H"
+            )
+
+    included = np.unique(atom_residues)
+    protein_residues = [
+        types.SimpleNamespace(ordinal_name=str(receptor.residue_keys[r]), residue_name=str(receptor.residue_names[r]))
+        for r in included
+        if receptor.is_protein_residue[r]
+    ]
+    residue_charges = np.bincount(atom_residues[indices >= 0], weights=receptor.charges[indices[indices >= 0]],
+                                  minlength=len(receptor.residue_keys)).astype(np.int64)
+    protein_charge_detail = {}
+    for r in included[residue_charges[included] != 0]:
+        detail = protein_charge_detail.setdefault(str(receptor.residue_names[r]), {"charge": 0, "count": 0})
+        detail["charge"] += int(residue_charges[r])
+        detail["count"] += 1
+
+    fragments, fragment_names = None, None
+    if getattr(request, "include_fragments", False):
+        boundaries = np.flatnonzero(np.diff(atom_residues)) + 1
+        fragments = [fragment.tolist() for fragment in np.split(np.arange(len(indices)), boundaries)]
+        fragment_names = [str(receptor.residue_keys[r]) for r in included]
+
+    is_protein_atom = receptor.is_protein_residue[atom_residues]
+    ligand_charge = int(ligand["charges"].sum())
+    ligand_charge_warning_info = None
+    if not (ligand["elements"] == "H").any():
+        ligand_charge_warning_info = "The ligand has no hydrogen atoms, its charge is only as good as its protonation."
+    elif not ligand["has_charges"]:
+        ligand_charge_warning_info = "The ligand PDB has no formal charge columns, its charge is taken as 0."
+
+    ligand_xyz_lines = ligand.get("xyz_lines") or _xyz_lines(ligand["elements"], ligand["coordinates"])
+    return CutoutResponse(
+        complex_xyz_base64=_base64(_xyz(ligand_xyz_lines + xyz_lines)),
+        ligand_xyz_base64=_base64(_xyz(ligand_xyz_lines)),
+        ligand_pdb_base64=_base64("\n".join(ligand["lines"] + ["END"]) + "\n"),
+        protein_xyz_base64=_base64(_xyz(xyz_lines)),
+        protein_pdb_base64=_base64("\n".join(pdb_lines + ["END"]) + "\n"),
+        ligand_charge=ligand_charge,
+        ligand_charge_warning_info=ligand_charge_warning_info,
+        protein_charge=int(residue_charges[included].sum()),
+        protein_charge_detail=protein_charge_detail,
+        protein_residues=protein_residues,
+        included_residues=[str(receptor.residue_keys[r]) for r in included],
+        fragments=fragments,
+        fragment_names=fragment_names,
+        number_of_protein_atoms=int(is_protein_atom.sum()),
+        number_of_non_protein_atoms=int((~is_protein_atom).sum()),
+    )
+
+
+def _xyz_lines(elements, coordinates):
+    return [f"{e:<2s} {x:14.6f} {y:14.6f} {z:14.6f}" for e, (x, y, z) in zip(elements, coordinates.tolist())]
+
+
+def _xyz(xyz_lines):
+    return f"{len(xyz_lines)}\n\n" + "\n".join(xyz_lines) + "\n"
+
+
+def _base64(text):
+    return base64.b64encode(text.encode("utf-8")).decode("utf-8")
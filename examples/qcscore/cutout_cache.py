@@ -0,0 +1,40 @@
+"""
+On-disk cache of the cutouts prepared by prom.preparation.cutout, shared by the qcscore
+examples. Cutouts are stored as JSON files named by a hash of their request, so any
+script preparing the same cutout again, also in a later run, reads it from the cache.
+"""
+import base64
+import hashlib
+import json
+import os
+import threading
+
+from promethium_sdk.models import PrepareCutoutResponse
+
+
+def cutout_hash(request) -> str:
+    """
+    Hash the cutout parameters and the decoded protein and ligand PDB bytes, so that
+    identical cutouts get the same hash whatever their base64 encoding.
+    """
+    parameters = request.model_dump(mode="json", exclude_none=True, exclude={"pdb_base64", "ligand_pdb_base64"})
+    digest = hashlib.sha256(json.dumps(parameters, sort_keys=True, separators=(",", ":")).encode("utf-8"))
+    for pdb_base64 in [request.pdb_base64, request.ligand_pdb_base64 or ""]:
+        digest.update(hashlib.sha256(base64.b64decode(pdb_base64)).digest())
+    return digest.hexdigest()
+
+
+def cached_cutout(prom, request, cache_dir):
+    """Prepare the cutout with prom.preparation.cutout, unless it is in `cache_dir`."""
+    cutout_path = os.path.join(cache_dir, f"{cutout_hash(request)}.json")
+    if os.path.exists(cutout_path):
+        with open(cutout_path, "r") as f:
+            return PrepareCutoutResponse.model_validate_json(f.read())
+    cutout = prom.preparation.cutout(request)
+    # Write to a temporary file first, so a concurrent reader never sees a partial cutout.
+    # It is named by process and thread, so concurrent writers never share it.
+    temporary_path = f"{cutout_path}.tmp{os.getpid()}.{threading.get_ident()}"
+    with open(temporary_path, "w") as f:
+        f.write(cutout.model_dump_json())
+    os.replace(temporary_path, cutout_path)
+    return cutout
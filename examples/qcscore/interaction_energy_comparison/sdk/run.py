@@ -1,5 +1,9 @@
 import copy
 import os
+import pathlib
+import queue
+import sys
+import threading
 import zipfile
 
 from promethium_sdk.utils import base64decode, base64encode, KCAL_PER_MOL_PER_HARTREE
@@ -12,13 +16,75 @@ from promethium_sdk.models import (
     WorkflowStatus
 )
 
+# The local cutout and the results cache live in examples/local_cutout.py and
+# examples/workflow_cache.py.
+sys.path.append(str(pathlib.Path(__file__).resolve().parents[3]))
+from local_cutout import local_cutout
+from workflow_cache import CachedWorkflows
+
+# The cutout cache and the project results stream live in examples/qcscore/.
+sys.path.append(str(pathlib.Path(__file__).resolve().parents[2]))
+from cutout_cache import cached_cutout
+from qcscore_results import iter_project_results
+
 foldername = "output"
 gpu_type = os.getenv("PM_GPU_TYPE", "a100-80gb")
 
+# Set PM_LOCAL_CUTOUT=1 to cut out the protein locally with examples/local_cutout.py
+# instead of prom.preparation.cutout, which saves a request per ligand.
+use_local_cutout = os.getenv("PM_LOCAL_CUTOUT", "0") == "1"
+
+# Cutouts prepared by prom.preparation.cutout are cached on disk by a hash of their
+# request, so re-runs of this (and any other) script do not cut out the same complex twice.
+cutout_cache_dir = os.getenv(
+    "PM_CUTOUT_CACHE_DIR", os.path.join(os.path.expanduser("~"), ".cache", "promethium", "cutouts")
+)
+
 if not os.path.exists(foldername):
     os.makedirs(foldername)
+os.makedirs(cutout_cache_dir, exist_ok=True)
+
+
+def start_stage(work, inbox, outbox=None, num_workers=1):
+    """
+    Start a pipeline stage of `num_workers` threads, which take items from the `inbox`
+    queue, and put the result of `work(item)` in the `outbox` queue unless it is None.
+    A None item ends the stage, which then passes a None on to the `outbox`. Errors are
+    reported and skip the item, so one bad ligand never stalls the pipeline.
+
+    The threads are daemon threads, so an error in the main thread is never held up by
+    a stage that is still waiting for its inbox.
+    """
+    def worker():
+        while (item := inbox.get()) is not None:
+            try:
+                result = work(item)
+            except Exception as e:
+                print(f"[WARNING] {work.__name__} failed: {e}")
+                continue
+            if result is not None and outbox is not None:
+                outbox.put(result)
+        # Pass the end of the stream on to the other workers of this stage.
+        inbox.put(None)
+
+    def stage():
+        threads = [threading.Thread(target=worker, daemon=True) for _ in range(num_workers)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        if outbox is not None:
+            outbox.put(None)
+
+    thread = threading.Thread(target=stage, daemon=True)
+    thread.start()
+    return thread
+
 
 prom = PromethiumClient()
+# Results of finished workflows never change, so they are cached on disk and shared
+# between runs of this (and any other) analysis script.
+prom.workflows = CachedWorkflows(prom.workflows)
 
 # Get the QCScore project workflow ID, and load the project settings.
 qcscore_project_id = input("Enter QCScore project ID: ")
@@ -61,44 +127,20 @@ default_ie_job_params["parameters"]["jk_builder"] = {
     },
 }
 
-# Collect all the results from the QCScore project.
-results_page = prom.projects.results(id=qcscore_project_id, page=1, size=10)
-all_results = results_page.items
-while (results_page.page * results_page.size) < results_page.total:
-    results_page = prom.projects.results(
-        id=qcscore_project_id,
-        page=results_page.page + 1,
-        size=results_page.size)
-    all_results.extend(results_page.items)
-print(f"Processing {len(all_results)} results for QCScore project '{qcscore_project.name}':")
-
 # Build a map where the key is the Fragmented Interaction Energy (FIE) workflow ID,
 # and the value contains a dictionary of values to identify the name and score,
 # and the Interaction Energy workflow ID.
 qcscore_results_by_fie_id = {}
-for r in all_results:
-    # Collect the FIE workflow information to populate the map.
-    score = None
-    if hasattr(r.results.root.results, "score"):
-        score = r.results.root.results.score * KCAL_PER_MOL_PER_HARTREE
-    qcscore_results_by_fie_id[r.target_resource_id] = {
-        "name": r.name,
-        "score": score,
-    }
-    if r.results.root.status != WorkflowStatus.COMPLETED:
-        print(f"Skipping '{r.name}' (FIE workflow id={r.target_resource_id}) with status {r.results.root.status.value}.")
-        continue
-    if score is None:
-        print(f"Skipping '{r.name}' (FIE workflow id={r.target_resource_id}) because score is missing.")
-        continue
 
-    # Download and unzip the FIE workflow results.
+
+def download_fie_results(r):
+    """Download and unzip the FIE workflow results, and read the optimized subsystem."""
     results_foldername = os.path.join(foldername, f"{r.target_resource_id}_{r.name}")
     if not os.path.exists(results_foldername):
         os.makedirs(results_foldername)
     results_zipfile = os.path.join(results_foldername, "results.zip")
     with open(results_zipfile, "wb") as fp:
-        fp.write(prom.workflows.download(r.target_resource_id))
+        fp.write(prom.workflows.download(r.target_resource_id, status=r.results.root.status))
     with zipfile.ZipFile(results_zipfile, "r") as zip_ref:
         zip_ref.extractall(results_foldername)
 
@@ -106,28 +148,35 @@ for r in all_results:
     subsystem_pdb_filepath = os.path.join(results_foldername, "optimized-subsystem.pdb")
     if not os.path.exists(subsystem_pdb_filepath):
         print(f"Skipping '{r.name}' (FIE workflow id={r.target_resource_id}) because optimized-subsystem.pdb file is missing.")
-        continue
+        return None
     with open(subsystem_pdb_filepath, "r") as f:
         subsystem_pdb_contents = f.read()
+    return r, results_foldername, subsystem_pdb_contents
+
 
-    # Prepare a cutout to separate the ligand from the protein, and save the results.
+def prepare_cutout(item):
+    """Prepare a cutout to separate the ligand from the protein, and save the results."""
+    r, results_foldername, subsystem_pdb_contents = item
     # We cutout with target_num_atoms high enough to collect all the protein atoms in the
     # subsystem, which must be less than the number of lines in the PDB file.
-    cutout = prom.preparation.cutout(
-        PrepareCutoutRequest(
-            pdb_base64=base64encode(subsystem_pdb_contents),
-            ligand_name="LIG",
-            target_num_atoms=subsystem_pdb_contents.count('\n'),
-            include_fragments=True,
-            neutral_termini=False,
-        )
+    cutout_request = PrepareCutoutRequest(
+        pdb_base64=base64encode(subsystem_pdb_contents),
+        ligand_name="LIG",
+        target_num_atoms=subsystem_pdb_contents.count('\n'),
+        include_fragments=True,
+        neutral_termini=False,
     )
+    cutout = local_cutout(cutout_request) if use_local_cutout else cached_cutout(prom, cutout_request, cutout_cache_dir)
     with open(os.path.join(results_foldername, "optimized-subsystem-ligand.xyz"), "w") as fp:
         fp.write(base64decode(cutout.ligand_xyz_base64))
     with open(os.path.join(results_foldername, "optimized-subsystem-protein.xyz"), "w") as fp:
         fp.write(base64decode(cutout.protein_xyz_base64))
+    return r, cutout
 
-    # Start an Interaction Energy workflow with the protein and ligand.
+
+def submit_interaction_energy(item):
+    """Start an Interaction Energy workflow with the protein and ligand."""
+    r, cutout = item
     ie_job_params = copy.deepcopy(default_ie_job_params)
     ie_job_params["name"] = r.name
     ie_job_params["parameters"]["molecule_a"]["base64data"] = cutout.ligand_xyz_base64
@@ -139,9 +188,50 @@ for r in all_results:
     qcscore_results_by_fie_id[r.target_resource_id]["ie_workflow_id"] = ie_workflow.id
     print(f"Started Interaction Energy workflow '{r.name}' (IE workflow id={ie_workflow.id}).")
 
+
+# Process the QCScore results in a pipeline of concurrent stages (download, cutout and
+# submit) connected by bounded queues, so the download and cutout of one ligand overlap
+# with the work for the others, and at most a few ligands are held in memory per stage.
+download_queue = queue.Queue(maxsize=8)
+cutout_queue = queue.Queue(maxsize=8)
+submit_queue = queue.Queue(maxsize=8)
+stages = [
+    start_stage(download_fie_results, download_queue, cutout_queue, num_workers=4),
+    start_stage(prepare_cutout, cutout_queue, submit_queue, num_workers=4),
+    start_stage(submit_interaction_energy, submit_queue),
+]
+
+# Collect all the results from the QCScore project, and feed them into the pipeline.
+print(f"Processing results for QCScore project '{qcscore_project.name}':")
+# The end of the stream is put in a finally block, so an error while listing the results
+# still ends the pipeline, and is raised once the stages have finished.
+try:
+    for r in iter_project_results(prom, qcscore_project_id):
+        # Collect the FIE workflow information to populate the map.
+        score = None
+        if hasattr(r.results.root.results, "score"):
+            score = r.results.root.results.score * KCAL_PER_MOL_PER_HARTREE
+        qcscore_results_by_fie_id[r.target_resource_id] = {
+            "name": r.name,
+            "score": score,
+        }
+        if r.results.root.status != WorkflowStatus.COMPLETED:
+            print(f"Skipping '{r.name}' (FIE workflow id={r.target_resource_id}) with status {r.results.root.status.value}.")
+            continue
+        if score is None:
+            print(f"Skipping '{r.name}' (FIE workflow id={r.target_resource_id}) because score is missing.")
+            continue
+        download_queue.put(r)
+finally:
+    download_queue.put(None)
+    for stage in stages:
+        stage.join()
+
 print()
 print("Waiting for Interaction Energy workflows to complete...")
 for key in qcscore_results_by_fie_id.keys():
+    if "ie_workflow_id" not in qcscore_results_by_fie_id[key]:
+        continue
     ie_workflow_id = qcscore_results_by_fie_id[key]["ie_workflow_id"]
     prom.workflows.wait(ie_workflow_id)
     ie_workflow = prom.workflows.get(ie_workflow_id)
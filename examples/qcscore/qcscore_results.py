@@ -0,0 +1,30 @@
+"""
+Streaming of the results of a Quantum Chemical Scoring project, shared by the qcscore
+examples.
+"""
+import collections
+import itertools
+import math
+from concurrent.futures import ThreadPoolExecutor
+
+
+def iter_project_results(prom, project_id, page_size=50, max_workers=8):
+    """
+    Yield every result of the project, in page order, as a stream. The first page gives
+    the total, and the remaining pages are prefetched concurrently by a pool of
+    `max_workers` threads, at most `2 * max_workers` pages ahead of the consumer.
+    """
+    first_page = prom.projects.results(id=project_id, page=1, size=page_size)
+    page_size = first_page.size
+    pages = iter(range(2, math.ceil(first_page.total / page_size) + 1))
+
+    def fetch(page):
+        return prom.projects.results(id=project_id, page=page, size=page_size)
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        pending = collections.deque(executor.submit(fetch, page) for page in itertools.islice(pages, 2 * max_workers))
+        yield from first_page.items
+        while pending:
+            results_page = pending.popleft().result()
+            pending.extend(executor.submit(fetch, page) for page in itertools.islice(pages, 1))
+            yield from results_page.items
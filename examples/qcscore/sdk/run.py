@@ -1,6 +1,14 @@
+import base64
+import collections
+import copy
+import hashlib
+import itertools
 import json
 import os
 import pathlib
+import sys
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
 
 from promethium_sdk.utils import base64encode, KCAL_PER_MOL_PER_HARTREE
 from promethium_sdk.client import PromethiumClient
@@ -22,8 +30,48 @@ from promethium_sdk.models import (
     WorkflowKind,
 )
 
+# The local cutout lives in examples/local_cutout.py.
+sys.path.append(str(pathlib.Path(__file__).resolve().parents[2]))
+from local_cutout import local_cutout
+
+# The cutout cache and the project results stream live in examples/qcscore/.
+sys.path.append(str(pathlib.Path(__file__).resolve().parents[1]))
+from cutout_cache import cached_cutout
+from qcscore_results import iter_project_results
+
+foldername = "output"
 gpu_type = os.getenv("PM_GPU_TYPE", "a100-80gb")
 
+# Embedded molecules at least this large (in base64 characters) are uploaded once to the
+# files API and referenced by file id in each workflow, instead of being copied into every
+# request body.
+upload_min_size = 16 * 1024
+
+# Local cache mapping the SHA-256 of uploaded molecule contents to their file ids.
+uploaded_molecules_path = os.path.join(foldername, "uploaded_molecules.json")
+
+# Ligand charges are inferred in chunks of at most this many bytes of base64 encoded SDF,
+# the size of the molecules in the request body (about 4/3 of the raw SDF), several chunks
+# at a time, and cached by molecule hash, also across re-runs of this script. The cache is
+# a JSON lines file that new charges are appended to.
+charges_chunk_bytes = 1024 * 1024
+ligand_charges_path = os.path.join(foldername, "ligand_charges.jsonl")
+
+# Set PM_LOCAL_CUTOUT=1 to prepare the protein cutout locally with examples/local_cutout.py
+# instead of prom.preparation.cutout, which saves a request per cutout when screening many
+# ligands against one receptor.
+use_local_cutout = os.getenv("PM_LOCAL_CUTOUT", "0") == "1"
+
+# Cutouts prepared by prom.preparation.cutout are cached on disk by a hash of their
+# request, so re-runs of this (and any other) script do not cut out the same complex twice.
+cutout_cache_dir = os.getenv(
+    "PM_CUTOUT_CACHE_DIR", os.path.join(os.path.expanduser("~"), ".cache", "promethium", "cutouts")
+)
+
+if not os.path.exists(foldername):
+    os.makedirs(foldername)
+os.makedirs(cutout_cache_dir, exist_ok=True)
+
 
 def extract_ligand_name(ligand_sdf: str) -> str:
     """
@@ -37,6 +85,142 @@ def extract_ligand_name(ligand_sdf: str) -> str:
     return ligand_name
 
 
+def upload_molecule(base64data: str, filetype: str) -> str:
+    """
+    Upload the molecule contents to the files API, and return the file id. Uploads are
+    keyed by the SHA-256 of the decoded contents, so each distinct molecule is uploaded
+    only once, including across re-runs of this script, as long as its file still
+    exists on the files API.
+    """
+    contents = base64.b64decode(base64data)
+    digest = hashlib.sha256(contents).hexdigest()
+
+    uploaded_molecules = {}
+    if os.path.exists(uploaded_molecules_path):
+        with open(uploaded_molecules_path, "r") as f:
+            uploaded_molecules = json.load(f)
+    if digest in uploaded_molecules:
+        try:
+            prom.files.metadata(uploaded_molecules[digest])
+            return uploaded_molecules[digest]
+        except Exception as e:
+            print(f"Uploaded file {uploaded_molecules[digest]} is no longer available ({e}), uploading again")
+
+    # The file is only needed for the upload, and is named by digest and file type
+    # so the files API sees the molecule format.
+    with tempfile.TemporaryDirectory() as upload_dir:
+        upload_path = os.path.join(upload_dir, f"{digest}.{filetype}" if filetype else digest)
+        with open(upload_path, "wb") as f:
+            f.write(contents)
+        file_id = str(prom.files.upload(upload_path).id)
+    print(f"Uploaded {len(contents)} byte {filetype or 'molecule'} file with file ID: {file_id}")
+
+    uploaded_molecules[digest] = file_id
+    with open(uploaded_molecules_path, "w") as f:
+        json.dump(uploaded_molecules, f, indent=2)
+    return file_id
+
+
+def reference_uploaded_molecules(properties):
+    """
+    Return a copy of the properties where every embedded molecule of at least
+    `upload_min_size` is replaced by a reference to its uploaded file id.
+    """
+    if isinstance(properties, dict):
+        base64data = properties.get("base64data")
+        if base64data is not None and len(base64data) >= upload_min_size:
+            molecule = {k: v for k, v in properties.items() if k != "base64data"}
+            molecule["id"] = upload_molecule(base64data, properties.get("filetype"))
+            return molecule
+        return {k: reference_uploaded_molecules(v) for k, v in properties.items()}
+    if isinstance(properties, list):
+        return [reference_uploaded_molecules(v) for v in properties]
+    return properties
+
+
+def molecule_hash(ligand_sdf: str) -> str:
+    """
+    Hash the molecule block of the ligand SDF string, from the counts line to `M  END`,
+    so the same molecule gets the same hash whatever its name, header or data fields.
+    """
+    ligand_sdf_lines = [line.rstrip() for line in ligand_sdf.lstrip().split("\n")[3:]]
+    if "M  END" in ligand_sdf_lines:
+        ligand_sdf_lines = ligand_sdf_lines[:ligand_sdf_lines.index("M  END") + 1]
+    return hashlib.sha256("\n".join(ligand_sdf_lines).encode("utf-8")).hexdigest()
+
+
+def infer_charges(ligand_sdf_texts, chunk_bytes=charges_chunk_bytes, max_workers=4):
+    """
+    Yield the (ligand name, inferred charge) of each ligand SDF string, in input order, as
+    a stream. Ligands that are not cached yet are sent to prom.molecule.charges in chunks of
+    at most `chunk_bytes` of base64 encoded SDF, as sent in the request, by a pool of
+    `max_workers` threads, at most `2 * max_workers` chunks ahead of the consumer. Cached
+    ligands count towards the size of their chunk too, so a long run of them never builds
+    one unbounded chunk. New charges are appended to the cache in `ligand_charges_path`.
+    """
+    cached_charges = {}
+    if os.path.exists(ligand_charges_path):
+        with open(ligand_charges_path, "r") as f:
+            for line in f:
+                if line.strip():
+                    record = json.loads(line)
+                    cached_charges[record["hash"]] = record["charge"]
+
+    def iter_chunks():
+        # Each uncached molecule is inferred once, in the chunk where it first appears.
+        chunk, uncached, total_bytes = [], {}, 0
+        scheduled = set(cached_charges)
+        for ligand_sdf in ligand_sdf_texts:
+            digest = molecule_hash(ligand_sdf)
+            base64data = None
+            if digest not in scheduled:
+                base64data = base64encode(ligand_sdf)
+                encoded_bytes = len(base64data)
+            else:
+                # The size the ligand would have in a request, without encoding it.
+                encoded_bytes = 4 * -(-len(ligand_sdf.encode("utf-8")) // 3)
+            if chunk and total_bytes + encoded_bytes > chunk_bytes:
+                yield chunk, uncached
+                chunk, uncached, total_bytes = [], {}, 0
+            if base64data is not None:
+                scheduled.add(digest)
+                uncached[digest] = base64data
+            total_bytes += encoded_bytes
+            chunk.append((ligand_sdf, digest))
+        if chunk:
+            yield chunk, uncached
+
+    def infer(uncached):
+        if not uncached:
+            return {}
+        response = prom.molecule.charges(
+            MoleculeChargesRequest(
+                molecules=[MoleculeInput(base64data=base64data, filetype="sdf") for base64data in uncached.values()]
+            )
+        )
+        return dict(zip(uncached.keys(), [x.inferred_charge for x in response.molecule_charges]))
+
+    chunks = iter_chunks()
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        pending = collections.deque(
+            (chunk, executor.submit(infer, uncached)) for chunk, uncached in itertools.islice(chunks, 2 * max_workers)
+        )
+        while pending:
+            chunk, future = pending.popleft()
+            charges = future.result()
+            pending.extend((chunk, executor.submit(infer, uncached)) for chunk, uncached in itertools.islice(chunks, 1))
+            # Chunks are consumed in order, so molecules inferred in an earlier chunk are
+            # already cached. Failed inferences (None) are not cached, to retry them next run.
+            new_charges = {digest: charge for digest, charge in charges.items() if charge is not None}
+            if new_charges:
+                cached_charges.update(new_charges)
+                with open(ligand_charges_path, "a") as f:
+                    for digest, charge in new_charges.items():
+                        f.write(json.dumps({"hash": digest, "charge": charge}) + "\n")
+            for ligand_sdf, digest in chunk:
+                yield extract_ligand_name(ligand_sdf), charges.get(digest, cached_charges.get(digest))
+
+
 prom = PromethiumClient()
 
 # Find the protein and ligand files in the parent directory.
@@ -54,24 +238,10 @@ ligand_sdf_texts = [
     if ligand.lstrip() != ""
 ]
 
-# Infer the charges for each ligand.
-ligand_charges_response = prom.molecule.charges(
-    MoleculeChargesRequest(
-        molecules=[
-            MoleculeInput(
-                base64data=base64encode(ligand_sdf_text),
-                filetype="sdf",
-            )
-            for ligand_sdf_text in ligand_sdf_texts
-        ]
-    )
-)
-ligand_charges = [x.inferred_charge for x in ligand_charges_response.molecule_charges]
-
-# Build a map of the ligand name to the corresponding molecule input.
+# Infer the charges for each ligand, and build a map of the ligand name to the
+# corresponding molecule input.
 ligand_name_to_molecule_input = {}
-for sdf_text, charge in zip(ligand_sdf_texts, ligand_charges):
-    ligand_name = extract_ligand_name(ligand_sdf=sdf_text)
+for sdf_text, (ligand_name, charge) in zip(ligand_sdf_texts, infer_charges(ligand_sdf_texts)):
     if ligand_name in ligand_name_to_molecule_input.keys():
         raise KeyError(f"Duplicate ligand name: {ligand_name}")
     if charge is None:
@@ -93,15 +263,14 @@ reference_ligand_base64data = prom.molecule.pdb(
         )
     )
 )
-cutout = prom.preparation.cutout(
-    PrepareCutoutRequest(
-        pdb_base64=protein_base64data,
-        ligand_pdb_base64=reference_ligand_base64data,
-        cutoff=5.0,
-        include_fragments=True,
-        neutral_termini=False,
-    )
+cutout_request = PrepareCutoutRequest(
+    pdb_base64=protein_base64data,
+    ligand_pdb_base64=reference_ligand_base64data,
+    cutoff=5.0,
+    include_fragments=True,
+    neutral_termini=False,
 )
+cutout = local_cutout(cutout_request) if use_local_cutout else cached_cutout(prom, cutout_request, cutout_cache_dir)
 
 print()
 print(f"Protein charge: {cutout.protein_charge}")
@@ -135,13 +304,17 @@ qcscore_project = prom.projects.create(
 print()
 print(f"Project '{qcscore_project.name}' created with ID: {qcscore_project.id}")
 
+# The workflow resources must be created with the same project settings.
+# The large protein structures are uploaded once and referenced by file id,
+# so they are not copied into the request body of every ligand workflow.
+shared_workflow_properties = reference_uploaded_molecules(project_properties.model_dump())
+
 # Create workflows for each ligand.
 project_workflow_ids = []
 for ligand_name, ligand_input in ligand_name_to_molecule_input.items():
-    # The workflow resources must be created with the same project settings.
     # Copy the project properties but rename the protein since that is configured
     # as an input molecule.
-    workflow_properties = project_properties.model_dump()
+    workflow_properties = copy.deepcopy(shared_workflow_properties)
     workflow_properties["molecule_a"] = ligand_input.model_dump()
     workflow_properties["molecule_b"] = workflow_properties.pop("protein")
 
@@ -169,10 +342,9 @@ for workflow_id in project_workflow_ids:
     print(f"Workflow '{workflow.name}' completed with status {workflow.status.value} in {workflow.duration_seconds:.2f}s")
 
 # Print the QCScore project results.
-project_results = prom.projects.results(id=qcscore_project.id, size=len(project_workflow_ids))
 ligand_scores = []
 ligand_errors = []
-for workflow_result in project_results.items:
+for workflow_result in iter_project_results(prom, qcscore_project.id):
     ligand_name = workflow_result.name
     if hasattr(workflow_result.results.root.results, "score"):
         ligand_score = workflow_result.results.root.results.score * KCAL_PER_MOL_PER_HARTREE
@@ -0,0 +1,75 @@
+"""
+Resumable, verified download of the results ZIP of a workflow through the REST API,
+shared by the httpx examples.
+"""
+import contextlib
+import hashlib
+
+import httpx
+
+
+def download_results(client, workflow_id, destination, chunk_size=1024 * 1024, max_attempts=5):
+    """
+    Stream the results ZIP of a workflow to `destination` (a path or a writable, seekable
+    file object) in fixed-size chunks through the httpx `client` of the REST API, so
+    memory use stays flat however large the archive.
+
+    A dropped connection resumes from the bytes already written with a Range request.
+    When the API redirects to a storage URL, the redirect is resolved once and resumed
+    requests go to the storage URL directly; when the API serves the archive itself,
+    they go through `client`, so they carry its API key.
+
+    The written size is checked against the Content-Length. The contents are checked
+    against the ETag only when it is a plain MD5 digest (32 hex characters), as for
+    single-part storage uploads; other ETags, e.g. of multipart uploads, are not a
+    digest of the contents, and then only the size is checked. Returns the number of
+    bytes written.
+    """
+    api_url = f"/v0/workflows/{workflow_id}/results/download"
+    download_url = None
+    redirected = False
+    expected_size = None
+    etag = ""
+    md5 = hashlib.md5()
+    written = 0
+    fp_context = contextlib.nullcontext(destination) if hasattr(destination, "write") else open(destination, "wb")
+    with fp_context as fp:
+        start = fp.tell()
+        for attempt in range(max_attempts):
+            try:
+                range_header = {"Range": f"bytes={written}-"}
+                if download_url is None:
+                    stream = client.stream("GET", api_url, follow_redirects=True)
+                elif redirected:
+                    stream = httpx.stream("GET", download_url, headers=range_header)
+                else:
+                    stream = client.stream("GET", api_url, headers=range_header)
+                with stream as response:
+                    response.raise_for_status()
+                    if download_url is None:
+                        download_url = str(response.url)
+                        redirected = bool(response.history)
+                        if "content-length" in response.headers:
+                            expected_size = int(response.headers["content-length"])
+                        etag = response.headers.get("etag", "").strip('"')
+                    elif response.status_code != 206:
+                        # The server ignored the Range header, so start over.
+                        fp.seek(start)
+                        fp.truncate()
+                        md5 = hashlib.md5()
+                        written = 0
+                    for chunk in response.iter_bytes(chunk_size):
+                        fp.write(chunk)
+                        md5.update(chunk)
+                        written += len(chunk)
+                break
+            except httpx.TransportError as e:
+                print(f"Download of {workflow_id} interrupted after {written} bytes ({e}), resuming...")
+        else:
+            raise IOError(f"Download of {workflow_id} failed after {max_attempts} attempts")
+
+    if expected_size is not None and written != expected_size:
+        raise IOError(f"Download of {workflow_id} is {written} bytes, expected {expected_size}")
+    if len(etag) == 32 and all(c in "0123456789abcdef" for c in etag.lower()) and md5.hexdigest() != etag.lower():
+        raise IOError(f"Download of {workflow_id} has MD5 {md5.hexdigest()}, expected {etag}")
+    return written
@@ -1,20 +1,180 @@
 import io
 import gzip
+import httpx
 import json
 import os
 import pathlib
+import sys
 import zipfile
 
+try:
+    import ijson
+    import numpy as np
+except ImportError:
+    raise ImportError("ijson and numpy are required, run `pip install ijson numpy`.")
+
 from promethium_sdk.utils import base64encode
 from promethium_sdk.client import PromethiumClient
 from promethium_sdk.models import (
     CreateGeometryOptimizationWorkflowRequest,
 )
 
+# The results cache lives in examples/workflow_cache.py.
+sys.path.append(str(pathlib.Path(__file__).resolve().parents[2]))
+from workflow_cache import CachedWorkflows
+
 GPU_TYPE = "a100"
 INPUT_FOLDER = pathlib.Path(__file__).parent.resolve()
 OUTPUT_FOLDER = "output"
 
+# Used by approach (3) below to resolve the storage URL of the results ZIP.
+BASE_URL = os.getenv("PM_API_BASE_URL", "https://api.promethium.qcware.com")
+
+
+class HttpRangeReader(io.RawIOBase):
+    """
+    A read-only, seekable file over an HTTP URL. Every read fetches only the requested
+    byte range, so `zipfile` can read the central directory at the end of an archive and
+    then individual members, without downloading the whole archive.
+
+    Every response must be a 206 with the requested Content-Range; a server that ignores
+    the Range header would otherwise send the whole archive for every read.
+    """
+
+    def __init__(self, url: str):
+        self.url = url
+        self.position = 0
+        self.bytes_fetched = 0
+        # Presigned storage URLs are usually only valid for GET, so request a single
+        # byte and read the total size from the Content-Range header.
+        response = self._get_range(0, 0)
+        self.size = int(response.headers["content-range"].rsplit("/", 1)[1])
+
+    def _get_range(self, start, end):
+        """GET bytes `start` to `end` (inclusive), and check the server sent only those."""
+        with httpx.stream("GET", self.url, headers={"Range": f"bytes={start}-{end}"}) as response:
+            response.raise_for_status()
+            content_range = response.headers.get("content-range", "")
+            if response.status_code != 206 or not content_range.startswith(f"bytes {start}-{end}/"):
+                raise IOError(
+                    f"Expected a 206 response for bytes {start}-{end}, got {response.status_code} "
+                    f"with Content-Range {content_range!r}; the server does not support range requests"
+                )
+            response.read()
+        return response
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self.position
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_SET:
+            self.position = offset
+        elif whence == io.SEEK_CUR:
+            self.position += offset
+        else:
+            self.position = self.size + offset
+        return self.position
+
+    def readinto(self, buffer):
+        end = min(self.position + len(buffer), self.size)
+        if self.position >= end:
+            return 0
+        data = self._get_range(self.position, end - 1).content
+        buffer[:len(data)] = data
+        self.position += len(data)
+        self.bytes_fetched += len(data)
+        return len(data)
+
+
+def load_optimization_path(path, fields=("geometry", "gradient", "energy"), use_cache=True):
+    """
+    Stream the `iteration` array of a geometry-optimization-result.json.gz file straight
+    into NumPy arrays, without building the whole document as Python objects.
+
+    Returns a dictionary with an (n_iter, n_atoms, 3) float64 array for each per-atom field
+    (geometries and gradients), and an (n_iter,) array for each scalar field (energies).
+    Iterations are written into preallocated arrays whose capacity doubles as needed.
+    When `use_cache` is set, the arrays are also saved as .npy files in `<path>.npy/`,
+    together with the list of fields that were parsed, and later loads of any of those
+    fields memory-map the .npy files instead of parsing the file again. Loading a field
+    that was not parsed yet parses the file again for it and the cached fields.
+    """
+    cache_dir = f"{path}.npy"
+    fields_path = os.path.join(cache_dir, "fields.json")
+    cached_fields = []
+    if use_cache and os.path.exists(fields_path) and os.path.getmtime(fields_path) >= os.path.getmtime(path):
+        with open(fields_path, "r") as f:
+            cached_fields = json.load(f)
+        if set(fields) <= set(cached_fields):
+            return {
+                field: np.load(os.path.join(cache_dir, f"{field}.npy"), mmap_mode="r")
+                for field in fields
+                if os.path.exists(os.path.join(cache_dir, f"{field}.npy"))
+            }
+    parse_fields = list(dict.fromkeys([*cached_fields, *fields]))
+
+    arrays = {}
+    n_iter = 0
+    with gzip.open(path, "rb") as fp:
+        for iteration in ijson.items(fp, "iteration.item", use_float=True):
+            for field in parse_fields:
+                if field not in iteration:
+                    continue
+                value = np.asarray(iteration[field], dtype=np.float64)
+                if value.ndim > 0:
+                    value = value.reshape(-1, 3)
+                if field not in arrays:
+                    arrays[field] = np.full((max(16, 2 * n_iter),) + value.shape, np.nan)
+                elif n_iter >= len(arrays[field]):
+                    # A field missing from earlier iterations may be more than one past capacity.
+                    grown = np.full((max(2 * len(arrays[field]), n_iter + 1),) + value.shape, np.nan)
+                    grown[:len(arrays[field])] = arrays[field]
+                    arrays[field] = grown
+                arrays[field][n_iter] = value
+            n_iter += 1
+    for field, array in arrays.items():
+        if len(array) < n_iter:
+            # The field is missing from the last iterations, past the capacity.
+            array = np.concatenate([array, np.full((n_iter - len(array),) + array.shape[1:], np.nan)])
+        arrays[field] = array[:n_iter]
+
+    if use_cache:
+        os.makedirs(cache_dir, exist_ok=True)
+        for field, array in arrays.items():
+            np.save(os.path.join(cache_dir, f"{field}.npy"), array)
+        # Written last, so an interrupted save is parsed again on the next load.
+        with open(fields_path, "w") as f:
+            json.dump(parse_fields, f)
+    return {field: array for field, array in arrays.items() if field in fields}
+
+
+def read_remote_artifacts(workflow_id, names):
+    """
+    Read only the named members of a workflow's results ZIP, using HTTP range requests
+    against the redirected download URL. Returns a dictionary of member name to bytes.
+    """
+    response = httpx.get(
+        f"{BASE_URL}/v0/workflows/{workflow_id}/results/download",
+        headers={"x-api-key": os.environ["PM_API_KEY"]},
+    )
+    if not response.is_redirect:
+        # The archive was returned directly, so there is nothing left to save.
+        response.raise_for_status()
+        with zipfile.ZipFile(io.BytesIO(response.content), "r") as zip_ref:
+            return {name: zip_ref.read(name) for name in names}
+
+    reader = HttpRangeReader(response.headers["location"])
+    with zipfile.ZipFile(io.BufferedReader(reader, buffer_size=64 * 1024), "r") as zip_ref:
+        artifacts = {name: zip_ref.read(name) for name in names}
+    print(f"Fetched {reader.bytes_fetched} of {reader.size} bytes to read {', '.join(names)}")
+    return artifacts
+
 if not os.path.exists(OUTPUT_FOLDER):
     os.makedirs(OUTPUT_FOLDER)
 
@@ -58,6 +218,9 @@ job_params = {
 }
 
 prom = PromethiumClient()
+# Results of finished workflows are cached on disk, so approaches (1) and (2) below
+# download the ZIP file only once.
+prom.workflows = CachedWorkflows(prom.workflows)
 go_payload = CreateGeometryOptimizationWorkflowRequest(**job_params)
 go_workflow = prom.workflows.submit(go_payload)
 print(f"Workflow submitted (id: {go_workflow.id})")
@@ -82,7 +245,7 @@ molecule_str = go_results.get_artifact("optimized-molecule")
 # Write the ZIP file to disk:
 zipfile_path = os.path.join(OUTPUT_FOLDER, "example-results.zip")
 with open(zipfile_path, "wb") as fp:
-    fp.write(prom.workflows.download(go_workflow.id))
+    fp.write(prom.workflows.download(go_workflow.id, status=go_workflow.status))
 
 # Unzip the downloaded file to a folder:
 unzip_folder = os.path.join(OUTPUT_FOLDER, go_workflow.name)
@@ -102,17 +265,16 @@ with zipfile.ZipFile(zipfile_path, "r") as zip_ref:
     #   'stdout.txt',
     # ]
 
-# Load the optimization path:
-with gzip.open(os.path.join(unzip_folder, "geometry-optimization-result.json.gz"), "rt") as fp:
-    optimization_path = json.load(fp)
+# Load the optimization path as arrays, streaming the iterations from the compressed file:
+optimization_path = load_optimization_path(os.path.join(unzip_folder, "geometry-optimization-result.json.gz"))
 
-# Sequence of gradients:
-gradients = [iter["gradient"] for iter in optimization_path["iteration"]]
+# Sequence of gradients, with shape (n_iter, n_atoms, 3):
+gradients = optimization_path["gradient"]
 
 # (2) Approach 2:
 # Extract the contents of the ZIP file in memory.
 
-zippy = zipfile.ZipFile(io.BytesIO(prom.workflows.download(go_workflow.id)), "r")
+zippy = zipfile.ZipFile(io.BytesIO(prom.workflows.download(go_workflow.id, status=go_workflow.status)), "r")
 
 # Read the optimization path from the in-memory ZIP file and decompress it:
 gzipped_optimization_path = zippy.read("geometry-optimization-result.json.gz")
@@ -130,4 +292,12 @@ print(f"Workflow log: {stdout.decode('utf-8')}")
 results = json.loads(zippy.read("results.json"))
 
 # Clean up the ZIP file:
-zippy.close()
\ No newline at end of file
+zippy.close()
+
+# (3) Approach 3:
+# Read only the members you need from the remote ZIP file, without downloading it.
+# This requires the PM_API_KEY environment variable to be set.
+
+artifacts = read_remote_artifacts(go_workflow.id, ["optimized-molecule.xyz", "results.json"])
+optimized_molecule_str = artifacts["optimized-molecule.xyz"].decode("utf-8")
+results = json.loads(artifacts["results.json"])
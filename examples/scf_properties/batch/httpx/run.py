@@ -1,15 +1,45 @@
+import asyncio
 import base64
+import contextlib
 import json
 import httpx
 import os
 import pathlib
+import sys
+from datetime import datetime, timedelta, timezone
 
-from promethium_sdk.utils import wait_for_workflows_to_complete
+# The shared SCF properties dataset helpers live in examples/scf_properties/scf_properties_dataset.py.
+sys.path.append(str(pathlib.Path(__file__).resolve().parents[2]))
+sys.path.append(str(pathlib.Path(__file__).resolve().parents[3]))
+from scf_properties_dataset import (
+    MULTIPOLE_COMPONENTS,
+    append_scf_properties,
+    flatten_scf_properties,
+    scf_properties_table,
+)
+from results_download import download_results
+from workflow_polling import wait_for_workflows_httpx
 
 foldername = "output"
 base_url = os.getenv("PM_API_BASE_URL", "https://api.promethium.qcware.com")
 gpu_type = os.getenv("PM_GPU_TYPE", "a100")
 
+# The SCF properties of all molecules are appended to this Parquet dataset.
+dataset_dir = os.path.join(foldername, "scf_properties_dataset")
+dataset_partition = "batch"
+
+# Maximum number of workflow submissions in flight at once.
+max_concurrent_submissions = 16
+
+# Submissions that are rate limited (429), refused as unavailable (503) or cannot connect
+# never reached a workflow, so they are retried with exponential backoff, up to this many
+# attempts in total. Other server errors (500, 502, 504) and dropped responses may come
+# after the workflow was accepted, so the submission is only retried when no workflow
+# of that name was created since it was sent.
+max_submission_attempts = 5
+retryable_status_codes = {429, 503}
+ambiguous_status_codes = {500, 502, 504}
+
 if not os.path.exists(foldername):
     os.makedirs(foldername)
 
@@ -22,7 +52,88 @@ headers = {
 molecule_workflow_ids = {}
 client = httpx.Client(base_url=base_url, headers=headers)
 
+
+async def submit_workflows(payloads, max_concurrency, max_attempts=max_submission_attempts):
+    """
+    Submit workflow payloads concurrently over a shared connection pool.
+
+    At most `max_concurrency` requests are in flight at once, and payloads are
+    only pulled from the iterable as slots free up, so arbitrarily large
+    batches can be streamed in. Yields (payload, response, error) triples in the
+    order the submissions finish: a failed submission yields its error instead
+    of a response, so it never aborts the rest of the batch.
+    """
+    limits = httpx.Limits(
+        max_connections=max_concurrency,
+        max_keepalive_connections=max_concurrency,
+    )
+    async with httpx.AsyncClient(base_url=base_url, headers=headers, limits=limits) as async_client:
+
+        async def find_submitted(payload, sent_at):
+            """Return the workflow of this name created since `sent_at`, or None."""
+            # Recent workflows come first, so the first page holds any this batch created.
+            response = await async_client.get(
+                "/v0/workflows", params={"kind": [payload["kind"]], "page": 1, "size": 100}
+            )
+            response.raise_for_status()
+            for workflow in response.json()["items"]:
+                created_at = datetime.fromisoformat(workflow["created_at"].replace("Z", "+00:00"))
+                if workflow["name"] == payload["name"] and created_at >= sent_at:
+                    return workflow
+            return None
+
+        async def submit(payload):
+            # A minute of slack for the clock difference with the server.
+            sent_at = datetime.now(timezone.utc) - timedelta(minutes=1)
+            for attempt in range(1, max_attempts + 1):
+                delay = 2.0 ** attempt
+                try:
+                    response = await async_client.post("/v0/workflows", json=payload)
+                    if response.status_code in retryable_status_codes and attempt < max_attempts:
+                        with contextlib.suppress(ValueError):
+                            delay = float(response.headers.get("retry-after", delay))
+                    elif response.status_code in ambiguous_status_codes and attempt < max_attempts:
+                        workflow = await find_submitted(payload, sent_at)
+                        if workflow is not None:
+                            return payload, workflow, None
+                    else:
+                        response.raise_for_status()
+                        return payload, response.json(), None
+                except (httpx.ConnectError, httpx.ConnectTimeout) as e:
+                    # The request never reached the server, so it is safe to send again.
+                    if attempt == max_attempts:
+                        return payload, None, e
+                except httpx.TransportError as e:
+                    # The request was sent, but the response was lost.
+                    try:
+                        workflow = await find_submitted(payload, sent_at)
+                    except httpx.HTTPError:
+                        return payload, None, e
+                    if workflow is not None:
+                        return payload, workflow, None
+                    if attempt == max_attempts:
+                        return payload, None, e
+                except (httpx.HTTPError, ValueError) as e:
+                    return payload, None, e
+                print(f"Submission of {payload['name']} failed (attempt {attempt}), retrying in {delay:.0f}s...")
+                await asyncio.sleep(delay)
+
+        payloads = iter(payloads)
+        pending = set()
+        while True:
+            for payload in payloads:
+                pending.add(asyncio.create_task(submit(payload)))
+                if len(pending) >= max_concurrency:
+                    break
+            if not pending:
+                break
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                yield task.result()
+
+
 # Find XYZ files in the parent directory and use the file name to identify the molecule.
+molecule_payloads = {}
 molecules_dir = pathlib.Path(__file__).parent.parent.resolve()
 for file in os.listdir(molecules_dir):
     if not file.endswith(".xyz"):
@@ -72,44 +183,52 @@ for file in os.listdir(molecules_dir):
     if metadata:
         job_params["metadata"] = metadata
 
-    # submit a SPC workflow using the above configuration
-    payload = job_params
-    jobname = payload["name"]
-    response = client.post("/v0/workflows", json=payload)
-    with open(os.path.join(foldername, f"{jobname}_submitted.json"), "w") as fp:
-        fp.write(json.dumps(response.json()))
-    workflow_id = response.json()["id"]
-    print(f"Workflow {jobname} submitted with id: {workflow_id}")
-    molecule_workflow_ids[mol_name] = workflow_id
-
-# Wait for all workflows to complete and get results.
+    molecule_payloads[mol_name] = job_params
+
+
+# Submit the SPC workflows concurrently, and record each id as soon as it is accepted.
+# Submissions that still fail after retrying are recorded, so they can be submitted again.
+failed_submissions = {}
+
+
+async def submit_molecules():
+    mol_names_by_jobname = {payload["name"]: mol_name for mol_name, payload in molecule_payloads.items()}
+    async for payload, response, error in submit_workflows(molecule_payloads.values(), max_concurrent_submissions):
+        jobname = payload["name"]
+        if error is not None:
+            print(f"Workflow {jobname} could not be submitted: {error}")
+            failed_submissions[mol_names_by_jobname[jobname]] = str(error)
+            continue
+        with open(os.path.join(foldername, f"{jobname}_submitted.json"), "w") as fp:
+            fp.write(json.dumps(response))
+        workflow_id = response["id"]
+        print(f"Workflow {jobname} submitted with id: {workflow_id}")
+        molecule_workflow_ids[mol_names_by_jobname[jobname]] = workflow_id
+
+
+asyncio.run(submit_molecules())
+if failed_submissions:
+    with open(os.path.join(foldername, "failed_submissions.json"), "w") as fp:
+        fp.write(json.dumps(failed_submissions, indent=2))
+    print(f"{len(failed_submissions)} workflow(s) could not be submitted, see {foldername}/failed_submissions.json")
+
+# Wait for all workflows to complete and get results, in the order they finish.
+mol_names_by_workflow_id = {workflow_id: mol_name for mol_name, workflow_id in molecule_workflow_ids.items()}
 molecule_names = []
-molecule_scf_properties = []
-for mol_workflow_id in molecule_workflow_ids.items():
-    mol_name = mol_workflow_id[0]
-    workflow_id = mol_workflow_id[1]
-
-    workflow = wait_for_workflows_to_complete(
-        client=client,
-        workflow_ids=[workflow_id],
-        log_events=["STATE_CHANGES"],
-        timeout=3600,
-    )[workflow_id]
-
-    # Get the status and Wall-clock time:
-    response = client.get(f"v0/workflows/{workflow_id}").json()
+molecule_rows = []
+for workflow in wait_for_workflows_httpx(client, mol_names_by_workflow_id.keys()):
+    workflow_id = workflow["id"]
+    mol_name = mol_names_by_workflow_id[workflow_id]
+    jobname = f"spc_{mol_name}"
+
+    # The listed workflow already contains the status and Wall-clock time:
     with open(os.path.join(foldername, f"{jobname}_status.json"), "w") as fp:
-        fp.write(json.dumps(response))
-    name = response["name"]
-    timetaken = response["duration_seconds"]
+        fp.write(json.dumps(workflow))
+    timetaken = workflow["duration_seconds"]
     print(f"Workflow {jobname} completed with status: {workflow['status']} in {timetaken:.2f}s")
 
     # Download results:
-    response = client.get(
-        f"/v0/workflows/{workflow_id}/results/download", follow_redirects=True
-    )
-    with open(os.path.join(foldername, f"{jobname}_results.zip"), "wb") as fp:
-        fp.write(response.content)
+    download_results(client, workflow_id, os.path.join(foldername, f"{jobname}_results.zip"))
 
     # Extract and collect the SCF properties contained in the numeric results:
     response = client.get(f"/v0/workflows/{workflow_id}/results").json()
@@ -117,36 +236,39 @@ for mol_workflow_id in molecule_workflow_ids.items():
         fp.write(json.dumps(response))
 
     molecule_names.append(mol_name)
-    molecule_scf_properties.append(response["results"]["scf_properties"])
+    molecule_rows.append(flatten_scf_properties(workflow_id, mol_name, response["results"]["scf_properties"]))
 
 # Print a table of the SCF properties for each molecule.
 print()
 print("        |" + " |".join([f"{k:>16s}" for k in molecule_names]))
 print("--------+" + "+".join(["-----------------" for k in molecule_names]))
 
+# Flatten the SCF properties into typed columns, and append them to the Parquet dataset.
+scf_table = scf_properties_table(molecule_rows)
+append_scf_properties(dataset_dir, scf_table, partition=dataset_partition)
+
 # Print the polar surface area.
-psa_values = [scf_props["polar_surface_area"] for scf_props in molecule_scf_properties]
+psa_values = scf_table["polar_surface_area"].to_pylist()
 print("    PSA |" + " |".join([f"{v:16.8f}" for v in psa_values]))
 
 # Print orbital energy properties.
-homo_values = [scf_props["orbital_energies"]["homo_index"] for scf_props in molecule_scf_properties]
+homo_values = scf_table["homo_index"].to_pylist()
 print("   HOMO |" + " |".join([f"{v:16.0f}" for v in homo_values]))
-lumo_values = [scf_props["orbital_energies"]["lumo_index"] for scf_props in molecule_scf_properties]
+lumo_values = scf_table["lumo_index"].to_pylist()
 print("   LUMO |" + " |".join([f"{v:16.0f}" for v in lumo_values]))
-alpha_homo = [scf_props["orbital_energies"]["alpha_homo_energy"] for scf_props in molecule_scf_properties]
+alpha_homo = scf_table["alpha_homo_energy"].to_pylist()
 print(" α HOMO |" + " |".join([f"{v:16.8f}" for v in alpha_homo]))
-alpha_lumo = [scf_props["orbital_energies"]["alpha_lumo_energy"] for scf_props in molecule_scf_properties]
+alpha_lumo = scf_table["alpha_lumo_energy"].to_pylist()
 print(" α LUMO |" + " |".join([f"{v:16.8f}" for v in alpha_lumo]))
-beta_homo = [scf_props["orbital_energies"]["beta_homo_energy"] for scf_props in molecule_scf_properties]
+beta_homo = scf_table["beta_homo_energy"].to_pylist()
 print(" β HOMO |" + " |".join([f"{v:16.8f}" for v in beta_homo]))
-beta_lumo = [scf_props["orbital_energies"]["beta_lumo_energy"] for scf_props in molecule_scf_properties]
+beta_lumo = scf_table["beta_lumo_energy"].to_pylist()
 print(" β LUMO |" + " |".join([f"{v:16.8f}" for v in beta_lumo]))
 
 # Print dipole and quadrupole moments.
-multipole_moments = [scf_props["multipole_moments"][0]["multipole_moments"] for scf_props in molecule_scf_properties]
-for vals in zip(*multipole_moments):
-    label = vals[0]["component_label"]
-    print(f"{label:>7s} |" + " |".join([f"{v['value']:16.8f}" for v in vals]))
+for label in MULTIPOLE_COMPONENTS:
+    vals = scf_table[f"multipole_{label}"].to_pylist()
+    print(f"{label:>7s} |" + " |".join([f"{v:16.8f}" for v in vals]))
 
 # This script will print a table which looks like this (with minor numerical differences):
 """
@@ -1,5 +1,6 @@
 import os
 import pathlib
+import sys
 
 from promethium_sdk.utils import base64encode
 from promethium_sdk.client import PromethiumClient
@@ -8,14 +9,35 @@ from promethium_sdk.models import (
     CreateSinglePointCalculationWorkflowRequest,
 )
 
+# The shared SCF properties dataset helpers live in examples/scf_properties/scf_properties_dataset.py.
+sys.path.append(str(pathlib.Path(__file__).resolve().parents[2]))
+sys.path.append(str(pathlib.Path(__file__).resolve().parents[3]))
+from scf_properties_dataset import (
+    MULTIPOLE_COMPONENTS,
+    append_scf_properties,
+    flatten_scf_properties,
+    scf_properties_table,
+)
+from workflow_polling import wait_for_workflows
+from workflow_submissions import load_submissions, submit_once
+
 foldername = "output"
 gpu_type = os.getenv("PM_GPU_TYPE", "a100")
 
+# The SCF properties of all molecules are appended to this Parquet dataset.
+dataset_dir = os.path.join(foldername, "scf_properties_dataset")
+dataset_partition = "batch"
+
+# Submitted workflows are recorded here by a hash of their calculation, so identical
+# calculations, also in later runs of this script, are not submitted twice.
+submissions_path = os.path.join(foldername, "submissions.jsonl")
+
 if not os.path.exists(foldername):
     os.makedirs(foldername)
 
 molecule_workflow_ids = {}
 prom = PromethiumClient()
+submissions = load_submissions(submissions_path)
 
 # Find XYZ files in the parent directory and use the file name to identify the molecule.
 molecules_dir = pathlib.Path(__file__).parent.parent.resolve()
@@ -55,27 +77,26 @@ for file in os.listdir(molecules_dir):
         "resources": {"gpu_type": gpu_type},
     }
     payload = CreateSinglePointCalculationWorkflowRequest(**job_params)
-    spc_workflow = prom.workflows.submit(payload)
-    print(f"Workflow {job_params.get('name')} submitted (id: {spc_workflow.id})")
+    spc_workflow = submit_once(prom, payload, submissions, submissions_path)
     molecule_workflow_ids[mol_name] = spc_workflow.id
 
-# Wait for all workflows to complete and get results.
+# Wait for all workflows to complete and get results, in the order they finish.
+# Molecules with identical calculations share one workflow.
+mol_names_by_workflow_id = {}
+for mol_name, workflow_id in molecule_workflow_ids.items():
+    mol_names_by_workflow_id.setdefault(str(workflow_id), []).append(mol_name)
 molecule_names = []
-molecule_scf_properties = []
-for mol_workflow_id in molecule_workflow_ids.items():
-    mol_name = mol_workflow_id[0]
-    workflow_id = mol_workflow_id[1]
-    prom.workflows.wait(workflow_id)
-
-    workflow = prom.workflows.get(workflow_id)
+molecule_rows = []
+for workflow in wait_for_workflows(prom, mol_names_by_workflow_id.keys()):
     print(f"Workflow {workflow.name} completed with status {workflow.status} in {workflow.duration_seconds:.2f}s")
 
     workflow_results = prom.workflows.results(workflow.id)
     with open(os.path.join(foldername, f"{workflow.name}_results.json"), "w") as fp:
         fp.write(workflow_results.model_dump_json(indent=2))
 
-    molecule_names.append(mol_name)
-    molecule_scf_properties.append(workflow_results.results["scf_properties"])
+    for mol_name in mol_names_by_workflow_id[str(workflow.id)]:
+        molecule_names.append(mol_name)
+        molecule_rows.append(flatten_scf_properties(workflow.id, mol_name, workflow_results.results["scf_properties"]))
 
     with open(os.path.join(foldername, f"{workflow.name}_results.zip"), "wb") as fp:
         fp.write(prom.workflows.download(workflow.id))
@@ -85,29 +106,32 @@ print()
 print("        |" + " |".join([f"{k:>16s}" for k in molecule_names]))
 print("--------+" + "+".join(["-----------------" for k in molecule_names]))
 
+# Flatten the SCF properties into typed columns, and append them to the Parquet dataset.
+scf_table = scf_properties_table(molecule_rows)
+append_scf_properties(dataset_dir, scf_table, partition=dataset_partition)
+
 # Print the polar surface area.
-psa_values = [scf_props["polar_surface_area"] for scf_props in molecule_scf_properties]
+psa_values = scf_table["polar_surface_area"].to_pylist()
 print("    PSA |" + " |".join([f"{v:16.8f}" for v in psa_values]))
 
 # Print orbital energy properties.
-homo_values = [scf_props["orbital_energies"]["homo_index"] for scf_props in molecule_scf_properties]
+homo_values = scf_table["homo_index"].to_pylist()
 print("   HOMO |" + " |".join([f"{v:16.0f}" for v in homo_values]))
-lumo_values = [scf_props["orbital_energies"]["lumo_index"] for scf_props in molecule_scf_properties]
+lumo_values = scf_table["lumo_index"].to_pylist()
 print("   LUMO |" + " |".join([f"{v:16.0f}" for v in lumo_values]))
-alpha_homo = [scf_props["orbital_energies"]["alpha_homo_energy"] for scf_props in molecule_scf_properties]
+alpha_homo = scf_table["alpha_homo_energy"].to_pylist()
 print(" α HOMO |" + " |".join([f"{v:16.8f}" for v in alpha_homo]))
-alpha_lumo = [scf_props["orbital_energies"]["alpha_lumo_energy"] for scf_props in molecule_scf_properties]
+alpha_lumo = scf_table["alpha_lumo_energy"].to_pylist()
 print(" α LUMO |" + " |".join([f"{v:16.8f}" for v in alpha_lumo]))
-beta_homo = [scf_props["orbital_energies"]["beta_homo_energy"] for scf_props in molecule_scf_properties]
+beta_homo = scf_table["beta_homo_energy"].to_pylist()
 print(" β HOMO |" + " |".join([f"{v:16.8f}" for v in beta_homo]))
-beta_lumo = [scf_props["orbital_energies"]["beta_lumo_energy"] for scf_props in molecule_scf_properties]
+beta_lumo = scf_table["beta_lumo_energy"].to_pylist()
 print(" β LUMO |" + " |".join([f"{v:16.8f}" for v in beta_lumo]))
 
 # Print dipole and quadrupole moments.
-multipole_moments = [scf_props["multipole_moments"][0]["multipole_moments"] for scf_props in molecule_scf_properties]
-for vals in zip(*multipole_moments):
-    label = vals[0]["component_label"]
-    print(f"{label:>7s} |" + " |".join([f"{v['value']:16.8f}" for v in vals]))
+for label in MULTIPOLE_COMPONENTS:
+    vals = scf_table[f"multipole_{label}"].to_pylist()
+    print(f"{label:>7s} |" + " |".join([f"{v:16.8f}" for v in vals]))
 
 # This script will print a table which looks like this (with minor numerical differences):
 """
@@ -1,6 +1,13 @@
 import os
+import pathlib
+import sys
 import zipfile
 
+try:
+    import numpy as np
+except ImportError:
+    raise ImportError("numpy is not installed, run `pip install numpy`.")
+
 from promethium_sdk.utils import base64encode
 from promethium_sdk.client import PromethiumClient
 from promethium_sdk.models import (
@@ -10,13 +17,82 @@ from promethium_sdk.models import (
     WorkflowKind,
 )
 
+# The shared SCF properties dataset helpers live in examples/scf_properties/scf_properties_dataset.py,
+# and the conformer ensemble, polling and submission helpers in examples/.
+sys.path.append(str(pathlib.Path(__file__).resolve().parents[2]))
+sys.path.append(str(pathlib.Path(__file__).resolve().parents[3]))
+from scf_properties_dataset import (
+    MULTIPOLE_COMPONENTS,
+    append_scf_properties,
+    flatten_scf_properties,
+    scf_properties_table,
+)
+from conformer_ensemble import conformer_xyz, load_conformers
+from workflow_polling import wait_for_workflows
+from workflow_submissions import load_submissions, submit_once
+
 foldername = "output"
 gpu_type = os.getenv("PM_GPU_TYPE", "a100")
 
+# The SCF properties of all conformers are appended to this Parquet dataset,
+# partitioned by the conformer search workflow name.
+dataset_dir = os.path.join(foldername, "scf_properties_dataset")
+
+# Conformers within this heavy-atom RMSD (Angstrom) of a lower energy conformer are not
+# recomputed, and at most this many cluster representatives are submitted (None for no cap).
+rmsd_threshold = float(os.getenv("PM_RMSD_THRESHOLD", "0.5"))
+max_representatives = 10
+
+# Submitted workflows are recorded here by a hash of their calculation, so identical
+# calculations, also in later runs of this script, are not submitted twice.
+submissions_path = os.path.join(foldername, "submissions.jsonl")
+
 if not os.path.exists(foldername):
     os.makedirs(foldername)
 
 prom = PromethiumClient()
+submissions = load_submissions(submissions_path)
+
+
+def kabsch_rmsd_matrix(coordinates):
+    """
+    Compute the minimum RMSD after optimal superposition (Kabsch) between every pair of
+    conformers in an (n_conf, n_atoms, 3) coordinate array, as an (n_conf, n_conf) matrix.
+
+    All pairs are aligned at once from the singular values of their 3x3 covariance
+    matrices, without building the rotated coordinates.
+    """
+    centered = coordinates - coordinates.mean(axis=1, keepdims=True)
+    n_atoms = centered.shape[1]
+    norms = np.einsum("ija,ija->i", centered, centered)
+    covariance = np.einsum("ika,jkb->ijab", centered, centered)
+    singular_values = np.linalg.svd(covariance, compute_uv=False)
+    # Flip the smallest singular value where the optimal rotation would be a reflection.
+    reflection = np.sign(np.linalg.det(covariance))
+    singular_values[..., 2] *= np.where(reflection == 0, 1.0, reflection)
+    squared = (norms[:, np.newaxis] + norms[np.newaxis, :] - 2.0 * singular_values.sum(axis=-1)) / n_atoms
+    return np.sqrt(np.clip(squared, 0.0, None))
+
+
+def cluster_conformers(conformers, rmsd_threshold, max_representatives=None, heavy_atoms_only=True):
+    """
+    Greedily cluster the conformers in rank (energy) order: a conformer becomes a cluster
+    representative unless it is within `rmsd_threshold` Angstrom of an earlier one.
+    Returns the ranks of at most `max_representatives` representatives.
+    """
+    coordinates = conformers["coordinates"]
+    if heavy_atoms_only and (conformers["elements"] != "H").any():
+        coordinates = coordinates[:, conformers["elements"] != "H"]
+    rmsd = kabsch_rmsd_matrix(coordinates)
+
+    representatives = []
+    for rank in range(len(rmsd)):
+        if not representatives or rmsd[rank, representatives].min() > rmsd_threshold:
+            representatives.append(rank)
+        if max_representatives is not None and len(representatives) >= max_representatives:
+            break
+    return representatives
+
 
 # Get the conformer search workflow and ensure that it succeeded.
 cs_workflow_id = input("Enter Conformer Search workflow ID: ")
@@ -36,6 +112,7 @@ if cs_workflow.status != WorkflowStatus.COMPLETED:
     print(f"ERROR: Workflow {cs_workflow.name} completed with status {cs_workflow.status}.")
     exit()
 print(f"Workflow {cs_workflow.name} completed with status {cs_workflow.status} in {cs_workflow.duration_seconds:.2f}s")
+dataset_partition = cs_workflow.name
 
 # Save the conformer search results.
 cs_workflow_results = prom.workflows.results(cs_workflow.id)
@@ -45,96 +122,114 @@ cs_results_zipfile_path = os.path.join(foldername, f"{cs_workflow.name}_results.
 with open(cs_results_zipfile_path, "wb") as fp:
     fp.write(prom.workflows.download(cs_workflow.id))
 
-# Collect the resulting conformers and start SinglePointCalculation workflows to get the SCF properties.
-spc_workflow_ids = []
+# Load all of the conformers from the results ZIP file into one coordinate array, and
+# start SinglePointCalculation workflows to get the SCF properties.
 with zipfile.ZipFile(cs_results_zipfile_path, "r") as zip_ref:
-    for rank, conformer_index in enumerate(cs_workflow_results.results["indices"]):
-        with zip_ref.open(f"conformer-{rank}.xyz") as f:
-            mol_name = f"C{conformer_index}"
-            mol_base64data = base64encode(f.read())
-
-        job_params = {
-            "name": f"spc_{cs_workflow.name}_{mol_name}",
-            "version": "v1",
-            "kind": "SinglePointCalculation",
-            "parameters": {
-                "molecule": {"base64data": mol_base64data, "filetype": "xyz"},
-                "system": {
-                    "params": {
-                        "basisname": "def2-svp",
-                        "methodname": "b3lyp",
-                        "xc_grid_scheme": "SG2",
-                    }
-                },
-                "hf": {
-                    "params": {"charge": 0, "multiplicity": 1, "g_convergence": 0.000001},
-                },
-                "scf_properties": {
-                    "outputs": [
-                        {"type": "multipole_moments", "expansion_order": "2"},
-                        {"type": "orbital_energies", "occupied_count": 5, "unoccupied_count": 5},
-                        {"type": "polar_surface_area"},
-                    ],
-                },
+    conformers = load_conformers(
+        "\n".join(
+            zip_ref.read(f"conformer-{rank}.xyz").decode("utf-8").strip()
+            for rank in range(len(cs_workflow_results.results["indices"]))
+        ),
+        cs_workflow_results.results,
+    )
+
+# Cluster near-duplicate conformers locally, and only submit one representative per cluster.
+representatives = cluster_conformers(conformers, rmsd_threshold, max_representatives)
+print(
+    f"Submitting {len(representatives)} of {len(conformers['indices'])} conformers "
+    f"(RMSD threshold {rmsd_threshold} A, at most {max_representatives} representatives)"
+)
+
+spc_workflow_ids = []
+for rank in representatives:
+    conformer_index = conformers["indices"][rank]
+    mol_name = f"C{conformer_index}"
+    mol_base64data = base64encode(conformer_xyz(conformers, rank, mol_name))
+
+    job_params = {
+        "name": f"spc_{cs_workflow.name}_{mol_name}",
+        "version": "v1",
+        "kind": "SinglePointCalculation",
+        "parameters": {
+            "molecule": {"base64data": mol_base64data, "filetype": "xyz"},
+            "system": {
+                "params": {
+                    "basisname": "def2-svp",
+                    "methodname": "b3lyp",
+                    "xc_grid_scheme": "SG2",
+                }
             },
-            "resources": {"gpu_type": gpu_type},
-        }
-        payload = CreateSinglePointCalculationWorkflowRequest(**job_params)
-        spc_workflow = prom.workflows.submit(payload)
-        print(f"Workflow {job_params.get('name')} submitted (id: {spc_workflow.id})")
-        spc_workflow_ids.append(spc_workflow.id)
-
-# Wait for all workflows to complete and get results.
-conformer_scf_properties = []
-for spc_workflow_id in spc_workflow_ids:
-    prom.workflows.wait(spc_workflow_id)
-
-    spc_workflow = prom.workflows.get(spc_workflow_id)
+            "hf": {
+                "params": {"charge": 0, "multiplicity": 1, "g_convergence": 0.000001},
+            },
+            "scf_properties": {
+                "outputs": [
+                    {"type": "multipole_moments", "expansion_order": "2"},
+                    {"type": "orbital_energies", "occupied_count": 5, "unoccupied_count": 5},
+                    {"type": "polar_surface_area"},
+                ],
+            },
+        },
+        "resources": {"gpu_type": gpu_type},
+    }
+    payload = CreateSinglePointCalculationWorkflowRequest(**job_params)
+    spc_workflow = submit_once(prom, payload, submissions, submissions_path)
+    spc_workflow_ids.append(spc_workflow.id)
+
+# Wait for all workflows to complete and get results as each one finishes.
+scf_rows_by_workflow_id = {}
+for spc_workflow in wait_for_workflows(prom, spc_workflow_ids):
     print(f"Workflow {spc_workflow.name} completed with status {spc_workflow.status} in {spc_workflow.duration_seconds:.2f}s")
 
     spc_workflow_results = prom.workflows.results(spc_workflow.id)
     with open(os.path.join(foldername, f"{spc_workflow.name}_results.json"), "w") as fp:
         fp.write(spc_workflow_results.model_dump_json(indent=2))
 
-    conformer_scf_properties.append(spc_workflow_results.results["scf_properties"])
+    scf_rows_by_workflow_id[str(spc_workflow.id)] = flatten_scf_properties(
+        spc_workflow.id, spc_workflow.name, spc_workflow_results.results["scf_properties"]
+    )
 
     with open(os.path.join(foldername, f"{spc_workflow.name}_results.zip"), "wb") as fp:
         fp.write(prom.workflows.download(spc_workflow.id))
 
-# Print a table of the SCF properties for each conformer.
-conformer_names = [f"C{k}" for k in cs_workflow_results.results["indices"]]
-conformer_ranks = [(k+1) for k in range(len(conformer_names))]
-conformer_abs_energies = [cs_workflow_results.results[f"conformer_{k}_energy"][-1] for k in cs_workflow_results.results["indices"]]
+# Print a table of the SCF properties for each conformer, in conformer rank order.
+conformer_rows = [scf_rows_by_workflow_id[str(k)] for k in spc_workflow_ids]
+conformer_names = [f"C{conformers['indices'][k]}" for k in representatives]
+conformer_ranks = [(k+1) for k in representatives]
+conformer_abs_energies = [cs_workflow_results.results[f"conformer_{conformers['indices'][k]}_energy"][-1] for k in representatives]
 print()
 print("            |" + " |".join([f"{k:>16s}" for k in conformer_names]))
 print("------------+" + "+".join(["-----------------" for k in conformer_names]))
 print("       Rank |" + " |".join([f"{v:16.0f}" for v in conformer_ranks]))
-print("     Weight |" + " |".join([f"{v:16.6f}" for v in cs_workflow_results.results["weights"]]))
-print(" Rel Energy |" + " |".join([f"{v:16.6f}" for v in cs_workflow_results.results["energies"]]))
+print("     Weight |" + " |".join([f"{v:16.6f}" for v in conformers["weights"][representatives]]))
+print(" Rel Energy |" + " |".join([f"{v:16.6f}" for v in conformers["energies"][representatives]]))
 print("     Energy |" + " |".join([f"{v:16.6f}" for v in conformer_abs_energies]))
 print("------------+" + "+".join(["-----------------" for k in conformer_names]))
 
 
+# Flatten the SCF properties into typed columns, and append them to the Parquet dataset.
+scf_table = scf_properties_table(conformer_rows)
+append_scf_properties(dataset_dir, scf_table, partition=dataset_partition)
+
 # Print the polar surface area.
-psa_values = [scf_props["polar_surface_area"] for scf_props in conformer_scf_properties]
+psa_values = scf_table["polar_surface_area"].to_pylist()
 print("        PSA |" + " |".join([f"{v:16.8f}" for v in psa_values]))
 
 # Print orbital energy properties.
-homo_values = [scf_props["orbital_energies"]["homo_index"] for scf_props in conformer_scf_properties]
+homo_values = scf_table["homo_index"].to_pylist()
 print("       HOMO |" + " |".join([f"{v:16.0f}" for v in homo_values]))
-lumo_values = [scf_props["orbital_energies"]["lumo_index"] for scf_props in conformer_scf_properties]
+lumo_values = scf_table["lumo_index"].to_pylist()
 print("       LUMO |" + " |".join([f"{v:16.0f}" for v in lumo_values]))
-alpha_homo = [scf_props["orbital_energies"]["alpha_homo_energy"] for scf_props in conformer_scf_properties]
+alpha_homo = scf_table["alpha_homo_energy"].to_pylist()
 print("     α HOMO |" + " |".join([f"{v:16.8f}" for v in alpha_homo]))
-alpha_lumo = [scf_props["orbital_energies"]["alpha_lumo_energy"] for scf_props in conformer_scf_properties]
+alpha_lumo = scf_table["alpha_lumo_energy"].to_pylist()
 print("     α LUMO |" + " |".join([f"{v:16.8f}" for v in alpha_lumo]))
-beta_homo = [scf_props["orbital_energies"]["beta_homo_energy"] for scf_props in conformer_scf_properties]
+beta_homo = scf_table["beta_homo_energy"].to_pylist()
 print("     β HOMO |" + " |".join([f"{v:16.8f}" for v in beta_homo]))
-beta_lumo = [scf_props["orbital_energies"]["beta_lumo_energy"] for scf_props in conformer_scf_properties]
+beta_lumo = scf_table["beta_lumo_energy"].to_pylist()
 print("     β LUMO |" + " |".join([f"{v:16.8f}" for v in beta_lumo]))
 
 # Print dipole and quadrupole moments.
-multipole_moments = [scf_props["multipole_moments"][0]["multipole_moments"] for scf_props in conformer_scf_properties]
-for vals in zip(*multipole_moments):
-    label = vals[0]["component_label"]
-    print(f"{label:>11s} |" + " |".join([f"{v['value']:16.8f}" for v in vals]))
+for label in MULTIPOLE_COMPONENTS:
+    vals = scf_table[f"multipole_{label}"].to_pylist()
+    print(f"{label:>11s} |" + " |".join([f"{v:16.8f}" for v in vals]))
@@ -0,0 +1,105 @@
+"""
+Shared helpers to collect SCF properties from many workflows into a columnar dataset.
+
+The nested `scf_properties` results are flattened once into typed columns and appended
+to a partitioned Parquet dataset, so queries over many molecules run as vectorized
+column scans instead of re-parsing the per-workflow results JSON.
+"""
+import os
+import uuid
+
+try:
+    import pyarrow
+    import pyarrow.compute
+    import pyarrow.dataset
+except ImportError:
+    raise ImportError("pyarrow is not installed, run `pip install pyarrow`.")
+
+# Multipole moment components up to the quadrupole (expansion order 2).
+MULTIPOLE_COMPONENTS = ["charge", "X", "Y", "Z", "XX", "XY", "XZ", "YY", "YZ", "ZZ"]
+
+# Atomic charge analysis methods, stored as one list column each.
+ATOMIC_CHARGE_METHODS = ["mulliken", "lowdin", "iao", "resp"]
+
+SCF_PROPERTIES_SCHEMA = pyarrow.schema(
+    [
+        ("workflow_id", pyarrow.string()),
+        ("name", pyarrow.string()),
+        ("polar_surface_area", pyarrow.float64()),
+        ("homo_index", pyarrow.int64()),
+        ("lumo_index", pyarrow.int64()),
+        ("alpha_homo_energy", pyarrow.float64()),
+        ("alpha_lumo_energy", pyarrow.float64()),
+        ("beta_homo_energy", pyarrow.float64()),
+        ("beta_lumo_energy", pyarrow.float64()),
+    ]
+    + [(f"multipole_{label}", pyarrow.float64()) for label in MULTIPOLE_COMPONENTS]
+    + [(f"{method}_charges", pyarrow.list_(pyarrow.float64())) for method in ATOMIC_CHARGE_METHODS]
+)
+
+
+def flatten_scf_properties(workflow_id, name, scf_properties):
+    """
+    Flatten the `scf_properties` results of one workflow into a row of the dataset.
+    Properties that were not requested are left empty.
+    """
+    row = {"workflow_id": str(workflow_id), "name": name}
+    row["polar_surface_area"] = scf_properties.get("polar_surface_area")
+
+    orbital_energies = scf_properties.get("orbital_energies") or {}
+    for key in ["homo_index", "lumo_index", "alpha_homo_energy", "alpha_lumo_energy", "beta_homo_energy", "beta_lumo_energy"]:
+        row[key] = orbital_energies.get(key)
+
+    for multipole_moments in scf_properties.get("multipole_moments") or []:
+        for component in multipole_moments["multipole_moments"]:
+            if component["component_label"] in MULTIPOLE_COMPONENTS:
+                row[f"multipole_{component['component_label']}"] = component["value"]
+
+    for atomic_charges in scf_properties.get("atomic_charges") or []:
+        if atomic_charges["analysis_method"] in ATOMIC_CHARGE_METHODS:
+            row[f"{atomic_charges['analysis_method']}_charges"] = atomic_charges["atomic_charges"]
+    return row
+
+
+def scf_properties_table(rows):
+    """Build a typed Arrow table from flattened rows."""
+    return pyarrow.Table.from_pylist(rows, schema=SCF_PROPERTIES_SCHEMA)
+
+
+def append_scf_properties(dataset_dir, table, partition):
+    """
+    Append the table to the Parquet dataset in `dataset_dir`, in the hive-style
+    partition `partition=<partition>`. Existing files are never rewritten.
+
+    Rows of workflows already in the partition are skipped, so re-running an example
+    does not duplicate them; only the `workflow_id` column of the partition is read to
+    find those. Returns the number of rows appended.
+    """
+    partition_dir = os.path.join(dataset_dir, f"partition={partition}")
+    if os.path.isdir(partition_dir):
+        existing_ids = pyarrow.dataset.dataset(partition_dir, format="parquet").to_table(columns=["workflow_id"])
+        is_new = pyarrow.compute.invert(pyarrow.compute.is_in(table["workflow_id"], existing_ids["workflow_id"]))
+        table = table.filter(is_new)
+    if len(table) == 0:
+        return 0
+    table = table.append_column("partition", pyarrow.array([partition] * len(table), pyarrow.string()))
+    pyarrow.dataset.write_dataset(
+        table,
+        dataset_dir,
+        format="parquet",
+        partitioning=["partition"],
+        partitioning_flavor="hive",
+        basename_template=f"part-{uuid.uuid4().hex}-{{i}}.parquet",
+        existing_data_behavior="overwrite_or_ignore",
+    )
+    return len(table)
+
+
+def read_scf_properties(dataset_dir, columns=None, filter=None):
+    """
+    Read the dataset in `dataset_dir` as an Arrow table, with optional column
+    projection and a `pyarrow.dataset` filter expression, e.g.
+    `pyarrow.dataset.field("polar_surface_area") > 200`.
+    """
+    dataset = pyarrow.dataset.dataset(dataset_dir, format="parquet", partitioning="hive")
+    return dataset.to_table(columns=columns, filter=filter)
@@ -2,12 +2,17 @@ import os
 import csv
 import json
 import copy
+import pathlib
+import sys
 
 from promethium_sdk.utils import base64encode
 from promethium_sdk.client import PromethiumClient
 from promethium_sdk.models import CreateTorsionScanWorkflowRequest
 from promethium_sdk.models import WorkflowStatus
 
+sys.path.append(str(pathlib.Path(__file__).resolve().parents[2]))
+from workflow_polling import wait_for_workflows
+
 # ---------------------------------------------------------------------------
 # Config
 # ---------------------------------------------------------------------------
@@ -16,6 +21,21 @@ CSV_PATH    = os.path.join(SCRIPT_DIR, "molecules.csv")
 CONFIG_PATH = os.path.join(SCRIPT_DIR, "torsion_scan-config.json")
 FOLDERNAME  = "output"
 
+# Failed workflows that ran out of memory or time are resubmitted with more resources,
+# up to MAX_ATTEMPTS attempts per molecule in each run. Out of memory failures move to
+# the next GPU type with more memory, then to more GPUs; timeouts double the timeouts.
+# Every attempt is recorded in LINEAGE_PATH, after the attempts of earlier runs.
+MAX_ATTEMPTS      = 3
+GPU_TYPES         = ["a100", "a100-80gb"]  # from least to most memory
+MAX_GPU_COUNT     = 4
+MAX_TIMEOUT       = 48 * 3600
+LINEAGE_PATH      = os.path.join(FOLDERNAME, "attempt_lineage.json")
+OOM_MARKERS       = ("out of memory", "out_of_memory", "outofmemory", "oomkilled", "memoryerror")
+TIMEOUT_MARKERS   = ("timeout", "timed out", "deadline exceeded")
+# The markers are only matched in these fields of the results, not in echoed parameters
+# such as the workflow timeout.
+ERROR_FIELDS      = ("error", "errors", "message", "detail", "reason")
+
 def read_file_to_string(filename: str) -> str:
     """Reads the entire content of a text file into a single string."""
     with open(filename, 'r', encoding='utf-8') as f:
@@ -25,6 +45,18 @@ def read_file_to_string(filename: str) -> str:
 with open(CONFIG_PATH, "r") as f:
     BASE_CONFIG = json.load(f)
 
+# Add metadata only if environment variables exist
+metadata = {}
+workflow_timeout = os.getenv("PM_WORKFLOW_TIMEOUT")
+task_timeout = os.getenv("PM_TASK_TIMEOUT")
+
+if workflow_timeout:
+    metadata["workflow_timeout"] = int(workflow_timeout)
+if task_timeout:
+    metadata["task_timeout"] = int(task_timeout)
+if metadata:
+    BASE_CONFIG["metadata"] = metadata
+
 print("Loaded config:")
 print(json.dumps(BASE_CONFIG, indent=2))
 print()
@@ -37,6 +69,104 @@ def safe_name(name: str) -> str:
     """Convert a molecule name into a filesystem/job-safe string."""
     return name.strip().replace(" ", "_").replace("/", "-")
 
+
+def error_messages(value, in_error_field=False):
+    """Yield the strings under any of the ERROR_FIELDS keys of nested results."""
+    if isinstance(value, dict):
+        for key, item in value.items():
+            yield from error_messages(item, in_error_field or key.lower() in ERROR_FIELDS)
+    elif isinstance(value, list):
+        for item in value:
+            yield from error_messages(item, in_error_field)
+    elif isinstance(value, str) and in_error_field:
+        yield value
+
+
+def classify_failure(workflow, job_params) -> str:
+    """
+    Classify a failed workflow as "oom", "timeout" or "other", from its duration against
+    the requested workflow timeout and from the error reported in its results.
+    """
+    timeout = job_params.get("metadata", {}).get("workflow_timeout")
+    if timeout and workflow.duration_seconds >= 0.95 * timeout:
+        return "timeout"
+
+    try:
+        report = "\n".join(error_messages(prom.workflows.results(workflow.id).model_dump(mode="json")))
+    except Exception as e:
+        report = str(e)
+    report = report.lower()
+    if any(marker in report for marker in OOM_MARKERS):
+        return "oom"
+    if any(marker in report for marker in TIMEOUT_MARKERS):
+        return "timeout"
+    return "other"
+
+
+def escalate(job_params, failure, duration_seconds):
+    """
+    Return a copy of the job parameters with more resources for the failure, or None
+    if the failure is not resource related or the resources cannot be raised further.
+    """
+    job_params = copy.deepcopy(job_params)
+    resources = job_params["resources"]
+    if failure == "oom":
+        gpu_type = resources.get("gpu_type", GPU_TYPES[0])
+        larger = GPU_TYPES[GPU_TYPES.index(gpu_type) + 1:] if gpu_type in GPU_TYPES else []
+        if larger:
+            resources["gpu_type"] = larger[0]
+        elif resources.get("gpu_count", 1) < MAX_GPU_COUNT:
+            resources["gpu_count"] = min(2 * resources.get("gpu_count", 1), MAX_GPU_COUNT)
+        else:
+            return None
+        return job_params
+
+    if failure == "timeout":
+        metadata = job_params.setdefault("metadata", {})
+        current = metadata.get("workflow_timeout") or max(int(duration_seconds), 3600)
+        if current >= MAX_TIMEOUT:
+            return None
+        metadata["workflow_timeout"] = min(2 * current, MAX_TIMEOUT)
+        if "task_timeout" in metadata:
+            metadata["task_timeout"] = min(2 * metadata["task_timeout"], MAX_TIMEOUT)
+        return job_params
+
+    return None
+
+
+def load_lineage():
+    """
+    Load the lineage recorded by earlier runs, and return it with the number of this run.
+    """
+    lineage = {}
+    if os.path.exists(LINEAGE_PATH):
+        with open(LINEAGE_PATH, "r") as fp:
+            lineage = json.load(fp)
+    last_run = max((a.get("run", 1) for attempts in lineage.values() for a in attempts), default=0)
+    return lineage, last_run + 1
+
+
+def run_attempts(lineage, job_name, run):
+    """Return the number of attempts of a job in the given run."""
+    return sum(1 for a in lineage.get(job_name, []) if a.get("run", 1) == run)
+
+
+def record_attempt(lineage, run, job_name, workflow, job_params, status, failure=None):
+    """Record one attempt of a job in the given run, and save the lineage of all jobs."""
+    attempts = lineage.setdefault(job_name, [])
+    attempt = next((a for a in attempts if a["workflow_id"] == str(workflow.id)), None)
+    if attempt is None:
+        attempt = {"attempt": len(attempts) + 1, "run": run, "workflow_id": str(workflow.id)}
+        attempts.append(attempt)
+    attempt.update(
+        resources=job_params["resources"],
+        metadata=job_params.get("metadata"),
+        status=status,
+        failure=failure,
+    )
+    with open(LINEAGE_PATH, "w") as fp:
+        json.dump(lineage, fp, indent=2)
+
 # ---------------------------------------------------------------------------
 # Main
 # ---------------------------------------------------------------------------
@@ -48,6 +178,8 @@ prom = PromethiumClient()
 
 # --- Read CSV and submit all jobs ---
 workflows = []  # list of (workflow, safe_name)
+job_params_by_name = {}
+lineage, run = load_lineage()
 
 print("Reading CSV and submitting torsion scan jobs...\n")
 
@@ -113,21 +245,43 @@ with open(CSV_PATH, newline="", encoding="utf-8") as csvfile:
         workflow = prom.workflows.submit(payload)
         print(f"workflow ID {workflow.id} submitted!\n")
         workflows.append((workflow, job_name))
+        job_params_by_name[job_name] = job_params
+        record_attempt(lineage, run, job_name, workflow, job_params, "SUBMITTED")
 
 print(f"\nSubmitted {len(workflows)} job(s). Waiting for completion...\n")
 
-# --- Wait for all jobs and collect results ---
-for workflow, job_name in workflows:
-    prom.workflows.wait(workflow.id)
-    workflow = prom.workflows.get(workflow.id)
+# --- Wait for all jobs and collect results as each one finishes ---
+# Failed jobs that ran out of memory or time are resubmitted with more resources.
+job_names_by_id = {str(workflow.id): job_name for workflow, job_name in workflows}
+outstanding = set(job_names_by_id)
+for workflow in wait_for_workflows(prom, outstanding):
+    job_name = job_names_by_id[str(workflow.id)]
+    job_params = job_params_by_name[job_name]
 
     print(f"Workflow {workflow.name} completed with status: {workflow.status}")
     print(f"  Duration: {workflow.duration_seconds:.2f}s")
 
     if workflow.status != WorkflowStatus.COMPLETED:
-        print("  [WARNING] Job did not complete successfully, skipping results.\n")
+        failure = classify_failure(workflow, job_params) if workflow.status == WorkflowStatus.FAILED else None
+        record_attempt(lineage, run, job_name, workflow, job_params, workflow.status.value, failure)
+        retry_params = escalate(job_params, failure, workflow.duration_seconds)
+        if retry_params is None or run_attempts(lineage, job_name, run) >= MAX_ATTEMPTS:
+            print(f"  [WARNING] Job did not complete successfully ({failure or workflow.status.value}), skipping results.\n")
+            continue
+
+        retry = prom.workflows.submit(CreateTorsionScanWorkflowRequest(**retry_params))
+        print(
+            f"  [RETRY] {failure}: resubmitted with resources {retry_params['resources']} "
+            f"and metadata {retry_params.get('metadata')} (id: {retry.id})\n"
+        )
+        job_names_by_id[str(retry.id)] = job_name
+        job_params_by_name[job_name] = retry_params
+        outstanding.add(str(retry.id))
+        record_attempt(lineage, run, job_name, retry, retry_params, "SUBMITTED")
         continue
 
+    record_attempt(lineage, run, job_name, workflow, job_params, workflow.status.value)
+
     results = prom.workflows.results(workflow.id)
 
     # Save full results JSON
@@ -0,0 +1,27 @@
+from datetime import datetime, timedelta, timezone
+
+from promethium_sdk.models import (
+    WorkflowKind,
+    WorkflowStatus,
+)
+from promethium_sdk.client import PromethiumClient
+
+from workflow_mirror import WorkflowMirror
+
+
+prom = PromethiumClient()
+
+# Mirror the workflow list of the account into a local SQLite file. The first sync
+# pages through every workflow; later syncs only fetch new and running workflows:
+mirror = WorkflowMirror("workflows.sqlite")
+fetched = mirror.sync(prom)
+print(f"Fetched {fetched} workflow(s) into workflows.sqlite")
+
+# Queries run offline against the mirror, e.g. the torsion scans completed this week:
+recent_ts_list = mirror.find(
+    kind=WorkflowKind.TorsionScan,
+    status=WorkflowStatus.COMPLETED,
+    created_after=datetime.now(timezone.utc) - timedelta(days=7),
+)
+for workflow in recent_ts_list:
+    print(f"{workflow.name} (id: {workflow.id}) completed in {workflow.duration_seconds:.2f}s")
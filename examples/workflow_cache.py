@@ -0,0 +1,118 @@
+"""
+On-disk cache of the results of finished workflows, shared by the results analysis
+examples. Results of a workflow in a terminal state never change, so they are fetched
+from the API once, and later reads, also in later runs of any example, are served from
+the cache.
+"""
+import hashlib
+import os
+import threading
+
+from promethium_sdk.models import WorkflowResult
+from promethium_sdk.utils import BYTES_PER_GB
+
+from workflow_polling import terminal_statuses
+
+# Set PM_RESULTS_CACHE_DIR to share the cache between machines or keep it elsewhere.
+default_cache_dir = os.getenv(
+    "PM_RESULTS_CACHE_DIR", os.path.join(os.path.expanduser("~"), ".cache", "promethium", "results")
+)
+default_max_bytes = 10 * BYTES_PER_GB
+
+
+class CachedWorkflows:
+    """
+    Wraps `prom.workflows` so that `results` and `download` of workflows in a terminal
+    state are served from a local on-disk cache, and only fetched from the API once.
+
+    Cached contents are stored by their SHA-256 under `objects/`, with a small index
+    file per workflow id pointing at them. Reading an object marks it as recently used,
+    and the least recently used objects are evicted once the cache exceeds `max_bytes`.
+    All other attributes are passed through to the wrapped client.
+    """
+
+    def __init__(self, workflows, cache_dir=default_cache_dir, max_bytes=default_max_bytes):
+        self.workflows = workflows
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        os.makedirs(os.path.join(cache_dir, "objects"), exist_ok=True)
+        os.makedirs(os.path.join(cache_dir, "index"), exist_ok=True)
+
+    def __getattr__(self, name):
+        return getattr(self.workflows, name)
+
+    def results(self, id):
+        data = self._read(id, "results.json")
+        if data is not None:
+            return WorkflowResult.model_validate_json(data)
+        workflow_results = self.workflows.results(id)
+        if workflow_results.status.value in terminal_statuses:
+            self._write(id, "results.json", workflow_results.model_dump_json().encode("utf-8"))
+        return workflow_results
+
+    def download(self, id, status=None):
+        """
+        Download the results ZIP of a workflow. Pass the `status` of the workflow when it
+        is already known, to save the request for it on a cache miss.
+        """
+        data = self._read(id, "results.zip")
+        if data is not None:
+            return data
+        # The status is checked before downloading, so a workflow that finishes during
+        # the download never has the partial results it had before cached.
+        if status is None:
+            status = self.workflows.status(id)
+        data = self.workflows.download(id)
+        if status.value in terminal_statuses:
+            self._write(id, "results.zip", data)
+        return data
+
+    def _read(self, workflow_id, name):
+        index_path = os.path.join(self.cache_dir, "index", f"{workflow_id}.{name}")
+        if not os.path.exists(index_path):
+            return None
+        with open(index_path, "r") as f:
+            object_path = os.path.join(self.cache_dir, "objects", f.read().strip())
+        try:
+            with open(object_path, "rb") as f:
+                data = f.read()
+        except FileNotFoundError:
+            # The object was evicted.
+            return None
+        os.utime(object_path)
+        return data
+
+    def _write(self, workflow_id, name, data):
+        digest = hashlib.sha256(data).hexdigest()
+        object_path = os.path.join(self.cache_dir, "objects", digest)
+        if os.path.exists(object_path):
+            os.utime(object_path)
+        else:
+            # Write to a temporary file first, so a concurrent reader never sees a partial object.
+            with open(f"{object_path}.tmp{os.getpid()}.{threading.get_ident()}", "wb") as f:
+                f.write(data)
+            os.replace(f"{object_path}.tmp{os.getpid()}.{threading.get_ident()}", object_path)
+        index_path = os.path.join(self.cache_dir, "index", f"{workflow_id}.{name}")
+        with open(f"{index_path}.tmp{os.getpid()}.{threading.get_ident()}", "w") as f:
+            f.write(digest)
+        os.replace(f"{index_path}.tmp{os.getpid()}.{threading.get_ident()}", index_path)
+        self._evict()
+
+    def _evict(self):
+        objects = []
+        for entry in os.scandir(os.path.join(self.cache_dir, "objects")):
+            try:
+                stat = entry.stat()
+            except FileNotFoundError:
+                continue
+            objects.append((stat.st_mtime, stat.st_size, entry.path))
+        total_bytes = sum(size for _, size, _ in objects)
+        for _, size, path in sorted(objects):
+            if total_bytes <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                # Already evicted by a concurrent writer.
+                pass
+            total_bytes -= size
@@ -0,0 +1,129 @@
+"""
+A local, indexed SQLite mirror of the workflows listed by prom.workflows.list.
+
+Finding workflows by kind, status, name or creation time in the mirror is an indexed
+query that runs offline in milliseconds, instead of paging through every workflow of
+the account. The mirror is brought up to date incrementally by `sync`.
+"""
+import sqlite3
+
+from promethium_sdk.models import ListWorkflowParams, Workflow
+
+from workflow_polling import terminal_statuses
+
+
+class WorkflowMirror:
+    """
+    SQLite mirror of the workflows of the account, stored in `path`.
+
+    `sync` pages through prom.workflows.list from the most recently created workflow,
+    and stops at the first page that is entirely older than the newest mirrored
+    workflow (the sync cursor). Mirrored workflows that were not finished yet are then
+    refreshed individually, so a sync costs requests for the new and running workflows
+    only, not for the whole account.
+    """
+
+    def __init__(self, path):
+        self.connection = sqlite3.connect(path)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        with self.connection:
+            self.connection.execute(
+                """
+                CREATE TABLE IF NOT EXISTS workflows (
+                    id TEXT PRIMARY KEY,
+                    name TEXT NOT NULL,
+                    kind TEXT NOT NULL,
+                    status TEXT NOT NULL,
+                    created_at REAL NOT NULL,
+                    last_updated_at REAL,
+                    duration_seconds REAL,
+                    workflow TEXT NOT NULL
+                )
+                """
+            )
+            self.connection.execute(
+                "CREATE INDEX IF NOT EXISTS workflows_kind_status ON workflows (kind, status, created_at)"
+            )
+            self.connection.execute("CREATE INDEX IF NOT EXISTS workflows_status ON workflows (status, created_at)")
+            self.connection.execute("CREATE INDEX IF NOT EXISTS workflows_name ON workflows (name)")
+            self.connection.execute("CREATE INDEX IF NOT EXISTS workflows_created_at ON workflows (created_at)")
+
+    def sync(self, prom, page_size=100):
+        """Bring the mirror up to date, and return the number of workflows fetched."""
+        cursor = self.connection.execute("SELECT MAX(created_at) FROM workflows").fetchone()[0]
+        seen = set()
+        page = 1
+        while True:
+            workflow_page = prom.workflows.list(ListWorkflowParams(page=page, size=page_size))
+            self._upsert(workflow_page.items)
+            seen.update(str(workflow.id) for workflow in workflow_page.items)
+            if cursor is not None and all(w.created_at.timestamp() <= cursor for w in workflow_page.items):
+                break
+            if page * page_size >= workflow_page.total:
+                break
+            page += 1
+
+        # Refresh the older workflows that were still running at the previous sync.
+        placeholders = ", ".join("?" * len(terminal_statuses))
+        in_flight = [
+            row[0]
+            for row in self.connection.execute(
+                f"SELECT id FROM workflows WHERE status NOT IN ({placeholders})", sorted(terminal_statuses)
+            )
+            if row[0] not in seen
+        ]
+        self._upsert([prom.workflows.get(workflow_id) for workflow_id in in_flight])
+        return len(seen) + len(in_flight)
+
+    def find(self, kind=None, status=None, name_prefix=None, created_after=None, created_before=None, limit=None):
+        """
+        Return the mirrored workflows matching all of the given filters, most recently
+        created first. `kind` and `status` are enum members or their values, and
+        `created_after` and `created_before` are timezone-aware datetimes.
+        """
+        conditions = []
+        values = []
+        if kind is not None:
+            conditions.append("kind = ?")
+            values.append(getattr(kind, "value", kind))
+        if status is not None:
+            conditions.append("status = ?")
+            values.append(getattr(status, "value", status))
+        if name_prefix:
+            # A range on the name, rather than LIKE, so that the name index is used.
+            conditions.append("name >= ? AND name < ?")
+            values.extend([name_prefix, name_prefix + "\U0010ffff"])
+        if created_after is not None:
+            conditions.append("created_at >= ?")
+            values.append(created_after.timestamp())
+        if created_before is not None:
+            conditions.append("created_at < ?")
+            values.append(created_before.timestamp())
+
+        query = "SELECT workflow FROM workflows"
+        if conditions:
+            query += " WHERE " + " AND ".join(conditions)
+        query += " ORDER BY created_at DESC"
+        if limit is not None:
+            query += f" LIMIT {int(limit)}"
+        return [Workflow.model_validate_json(row[0]) for row in self.connection.execute(query, values)]
+
+    def _upsert(self, workflows):
+        rows = [
+            (
+                str(workflow.id),
+                workflow.name,
+                workflow.kind.value,
+                workflow.status.value,
+                workflow.created_at.timestamp(),
+                workflow.last_updated_at.timestamp() if workflow.last_updated_at else None,
+                workflow.duration_seconds,
+                workflow.model_dump_json(),
+            )
+            for workflow in workflows
+        ]
+        with self.connection:
+            self.connection.executemany(
+                "INSERT OR REPLACE INTO workflows VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                rows,
+            )
@@ -0,0 +1,128 @@
+"""
+Bulk polling of a batch of workflows, shared by the examples that wait on many
+workflows at once.
+
+The first poll gets each workflow individually, which also tells their kinds and
+creation times. Later polls list only workflows of those kinds, newest first, and
+stop paging at the oldest outstanding workflow, so a poll costs the pages since the
+batch was created. Whenever that is more requests than there are outstanding
+workflows, they are got individually again instead.
+
+`wait_for_workflows` polls through the SDK client, and `wait_for_workflows_httpx`
+through an httpx client of the REST API, so it does not need the SDK installed.
+"""
+import time
+from collections import namedtuple
+from datetime import datetime
+
+# Workflow statuses after which a workflow will no longer change.
+terminal_statuses = {"COMPLETED", "FAILED", "CANCELLED"}
+
+# What polling needs to know about a workflow, next to the workflow as returned by the API.
+WorkflowState = namedtuple("WorkflowState", ["id", "kind", "status", "created_at", "workflow"])
+
+
+def poll_workflows(
+    get_workflow, list_workflows, workflow_ids, timeout=None, min_interval=5.0, max_interval=60.0, page_size=100
+):
+    """
+    Poll the workflows and yield each one as it reaches a terminal status, in
+    completion order.
+
+    `get_workflow(workflow_id)` returns a `WorkflowState`, and
+    `list_workflows(kinds, page, size)` returns a page of them, newest first, with the
+    total number of workflows of those kinds. If `workflow_ids` is a set of string
+    ids, finished ids are removed from it, and ids added to it while iterating (e.g.
+    resubmitted workflows) are picked up by the next poll.
+
+    There is no time limit unless `timeout` is given in seconds, after which
+    TimeoutError is raised. The poll interval grows while nothing finishes and resets
+    as soon as something does.
+    """
+    if isinstance(workflow_ids, set):
+        outstanding = workflow_ids
+    else:
+        outstanding = {str(workflow_id) for workflow_id in workflow_ids}
+    deadline = None if timeout is None else time.monotonic() + timeout
+    interval = min_interval
+    states = {}
+    pages_needed = None
+    while outstanding:
+        found = {}
+        known = [states[workflow_id] for workflow_id in outstanding if workflow_id in states]
+        if known and pages_needed is not None and pages_needed < len(outstanding):
+            kinds = list({state.kind for state in known})
+            oldest = min(state.created_at for state in known)
+            page = 1
+            while True:
+                states_page, total = list_workflows(kinds, page, page_size)
+                found.update((state.id, state) for state in states_page if state.id in outstanding)
+                if len(found) == len(outstanding) or page * page_size >= total:
+                    break
+                if not states_page or states_page[-1].created_at < oldest:
+                    break
+                page += 1
+            pages_needed = page
+        for workflow_id in outstanding - found.keys():
+            found[workflow_id] = get_workflow(workflow_id)
+        if pages_needed is None:
+            pages_needed = 1
+        states.update(found)
+
+        finished = [state for state in found.values() if state.status in terminal_statuses]
+        for state in finished:
+            outstanding.discard(state.id)
+            states.pop(state.id)
+            yield state.workflow
+        if not outstanding:
+            break
+        if deadline is not None and time.monotonic() + interval > deadline:
+            raise TimeoutError(f"{len(outstanding)} workflow(s) did not complete within {timeout}s")
+        interval = min_interval if finished else min(interval * 1.5, max_interval)
+        time.sleep(interval)
+
+
+def wait_for_workflows(prom, workflow_ids, **kwargs):
+    """
+    Poll the workflows through the SDK client `prom`, and yield each workflow as it
+    reaches a terminal status. Keyword arguments are passed to `poll_workflows`.
+    """
+    # Imported here, so the httpx examples can use this module without the SDK.
+    from promethium_sdk.models import ListWorkflowParams
+
+    def state(workflow):
+        return WorkflowState(str(workflow.id), workflow.kind, workflow.status.value, workflow.created_at, workflow)
+
+    def get_workflow(workflow_id):
+        return state(prom.workflows.get(workflow_id))
+
+    def list_workflows(kinds, page, size):
+        workflow_page = prom.workflows.list(ListWorkflowParams(kind=kinds, page=page, size=size))
+        return [state(workflow) for workflow in workflow_page.items], workflow_page.total
+
+    return poll_workflows(get_workflow, list_workflows, workflow_ids, **kwargs)
+
+
+def wait_for_workflows_httpx(client, workflow_ids, **kwargs):
+    """
+    Poll the workflows through the httpx `client` of the REST API, and yield each
+    workflow, as a dict, as it reaches a terminal status. Keyword arguments are passed
+    to `poll_workflows`.
+    """
+
+    def state(workflow):
+        created_at = datetime.fromisoformat(workflow["created_at"].replace("Z", "+00:00"))
+        return WorkflowState(workflow["id"], workflow["kind"], workflow["status"], created_at, workflow)
+
+    def get_workflow(workflow_id):
+        response = client.get(f"/v0/workflows/{workflow_id}")
+        response.raise_for_status()
+        return state(response.json())
+
+    def list_workflows(kinds, page, size):
+        response = client.get("/v0/workflows", params={"kind": kinds, "page": page, "size": size})
+        response.raise_for_status()
+        workflow_page = response.json()
+        return [state(workflow) for workflow in workflow_page["items"]], workflow_page["total"]
+
+    return poll_workflows(get_workflow, list_workflows, workflow_ids, **kwargs)
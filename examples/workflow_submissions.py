@@ -0,0 +1,71 @@
+"""
+Deduplicated workflow submission, shared by the examples that submit many similar
+calculations.
+
+Workflows are identified by a hash of their calculation, so an identical calculation,
+also in a later run of an example, reuses the workflow that was already submitted.
+Submissions are appended to a JSON lines file as they are made, so recording one costs
+the same however many were made before.
+"""
+import base64
+import hashlib
+import json
+import os
+
+from workflow_polling import terminal_statuses
+
+
+def submission_hash(payload) -> str:
+    """
+    Hash the workflow kind, the normalized parameters and the decoded molecule bytes,
+    so that identical calculations get the same hash whatever their name, resources
+    or parameter formatting.
+    """
+    request = payload.model_dump(mode="json", exclude_none=True, include={"kind", "version", "parameters"})
+    molecule = request["parameters"].pop("molecule", {})
+    request["molecule"] = {k: v for k, v in molecule.items() if k != "base64data"}
+    digest = hashlib.sha256(json.dumps(request, sort_keys=True, separators=(",", ":")).encode("utf-8"))
+    digest.update(base64.b64decode(molecule.get("base64data", "")))
+    return digest.hexdigest()
+
+
+def load_submissions(path):
+    """
+    Load the submissions recorded in the JSON lines file at `path`, as a dictionary of
+    submission hash to workflow id. Later lines override earlier ones.
+    """
+    submissions = {}
+    if os.path.exists(path):
+        with open(path, "r") as f:
+            for line in f:
+                if line.strip():
+                    record = json.loads(line)
+                    submissions[record["hash"]] = record["workflow_id"]
+    return submissions
+
+
+def submit_once(prom, payload, submissions, path):
+    """
+    Submit the workflow, unless an identical one was already submitted: a completed or
+    still running match is returned instead, and only failed or cancelled matches are
+    submitted again.
+
+    `submissions` is the dictionary returned by `load_submissions(path)`. A new
+    submission is added to it and appended to the file at `path`.
+    """
+    digest = submission_hash(payload)
+    if digest in submissions:
+        workflow = prom.workflows.get(submissions[digest])
+        if workflow.status.value == "COMPLETED":
+            print(f"Workflow {payload.name} reuses completed workflow {workflow.name} (id: {workflow.id})")
+            return workflow
+        if workflow.status.value not in terminal_statuses:
+            print(f"Workflow {payload.name} attaches to running workflow {workflow.name} (id: {workflow.id})")
+            return workflow
+
+    workflow = prom.workflows.submit(payload)
+    print(f"Workflow {payload.name} submitted (id: {workflow.id})")
+    submissions[digest] = str(workflow.id)
+    with open(path, "a") as f:
+        f.write(json.dumps({"hash": digest, "workflow_id": str(workflow.id)}) + "\n")
+    return workflow